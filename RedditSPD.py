@@ -1,14 +1,32 @@
 import argparse
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from io import BytesIO
+import html
 import os
 from pathlib import Path
-import random
+import queue
 import subprocess
+import threading
 import time
+from urllib.parse import urlparse
 
-from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+
+from archive_audit import check_file
+from archive_index import ArchiveIndex
+from dash_manifest import parse_mpd, select_representations
+from listing_cache import ListingCache
+from media_store import MediaStore
+from metrics import Metrics
+from packed_archive import PackedArchive
+from record_writer import RecordWriter, export_text, read_records, read_unique_records
+from image_metadata import convert_to_jpeg, inject_exif, is_jpeg
+from rate_limiter import BandwidthLimiter, RateLimiter, parse_retry_after
+from resume_journal import ResumeJournal
 
 
 class RedditSPD:
@@ -17,17 +35,93 @@ class RedditSPD:
     Optionally, provide `from_id` and/or `to_id` to specify the Reddit post IDs as the 
     starting point and ending point for the download.'''
 
+    # Fields of the listing kept for each saved media post, everything else is dropped while streaming.
+    post_fields = (
+        "id", "title", "link_title", "author", "permalink", "url", "domain", "selftext", "body", "link_permalink",
+        "is_gallery", "gallery_data", "is_self", "is_video", "media_metadata", "preview", "secure_media", "crosspost_parent", "crosspost_parent_list",
+        "name", "subreddit", "created_utc", "score", "over_18", "link_id", "link_author", "link_url", "parent_id"
+    )
+
     def __init__(self) -> None:
 
         self.username = ""
-        self.path = Path(__file__).parent if "__file__" in locals() else Path.cwd()
+        self.root_path = Path(__file__).parent if "__file__" in locals() else Path.cwd()
+        self.path = self.root_path
         self.image_path = ""
         self.video_path = ""
         self.selfpost_path = ""
-        self.session = requests.session()
         self.retries = 5
         self.vid_size_cutoff = 2097152
         self.vid_chunk_size = 1048576
+        # Limits for the video quality picked from the DASH playlist, None for the best available.
+        self.max_video_height = None
+        self.max_video_bitrate = None
+        self.max_video_bytes = None
+        self.segment_workers = 4
+        self.stream_chunk_size = 65536
+        self.mux_workers = 2
+        self._mux_executor = None
+        self.image_workers = os.cpu_count() or 1
+        self.gallery_workers = 4
+        # "mp4" saves GIFs as tagged mp4 files (the mp4 variant from Reddit, or transcoded), "gif" keeps the original.
+        self.gif_policy = "mp4"
+        # Limits for the image rendition to download, None for the original image.
+        self.max_image_width = None
+        self.max_image_bytes = None
+        self._image_executor = None
+        self.incremental = False
+        self.index = None
+        self.media_store = None
+        # Packed mode: the media is written into size-capped tar shards instead of one file per item.
+        self.packed = False
+        self.shard_size = 1024 * 1024 * 1024
+        self.packed_archive = None
+        self.audit_workers = os.cpu_count() or 1
+        self.queue_size = 100
+        # Scheduling: the posts waiting in the queue are downloaded smallest first, based on these estimates.
+        self.image_size_estimate = 512 * 1024
+        self.gif_size_estimate = 2 * 1024 * 1024
+        self.video_size_estimate = 20 * 1024 * 1024
+        # Global download speed cap in bytes per second, and time limit of the run in seconds (None for no limit).
+        self.max_bytes_per_sec = None
+        self.time_limit = None
+        self._bandwidth = None
+        self._deadline = None
+        self.writers = {}
+        self.save_snapshots = True
+        self._snapshot = None
+        self.export_text = False
+        self.metrics = Metrics()
+        self.prometheus_path = None
+        self.global_slots = None
+        self.use_listing_cache = True
+        self.listing_cache_size = 64 * 1024 * 1024
+        self.listing_cache = None
+        self.workers = 1
+        # What to do with a video that is already in the archive: "skip" or "overwrite".
+        self.existing_videos = "skip"
+        self.host_limits = {
+            "old.reddit.com": 2,
+            "i.redd.it": 8,
+            "preview.redd.it": 8,
+            "v.redd.it": 4
+        }
+        self.default_host_limit = 4
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
+        # Requests per second and burst size allowed for each host.
+        self.host_rates = {
+            "old.reddit.com": (1.0, 5),
+            "i.redd.it": (20.0, 20),
+            "preview.redd.it": (20.0, 20),
+            "v.redd.it": (20.0, 20)
+        }
+        self.default_host_rate = (10.0, 10)
+        self.permanent_codes = [400, 401, 403, 404, 410, 451]
+        self._limiters = {}
+        self._print_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self.session = self._new_session()
         self.headers = {
             "headers_img": {
                 "Accept": "image/avif,image/webp,*/*",
@@ -126,163 +220,506 @@ class RedditSPD:
         }
 
 
+    def _new_session(self) -> requests.Session:
+        '''Returns a new session with a connection pool large enough for the concurrent workers of every host.'''
+
+        session = requests.session()
+        pool_size = max([self.default_host_limit, *self.host_limits.values()])
+        adapter = HTTPAdapter(pool_connections=len(self.host_limits) + 1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        '''Context manager that holds one of the concurrent connection slots of the host of the provided url.'''
+
+        host = urlparse(url).hostname
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                limit = self.host_limits.get(host, self.default_host_limit)
+                self._host_semaphores[host] = threading.BoundedSemaphore(limit)
+            semaphore = self._host_semaphores[host]
+        with self.metrics.stage("request_wait"):
+            semaphore.acquire()
+            if self.global_slots is not None:
+                # Connection cap shared by all the processes of a batch run.
+                self.global_slots.acquire()
+        try:
+            yield
+        finally:
+            if self.global_slots is not None:
+                self.global_slots.release()
+            semaphore.release()
+
+
+    def _print(self, text: str) -> None:
+        '''Prints progress text without interleaving lines from concurrent workers.'''
+
+        with self._print_lock:
+            print(text)
+
+
+    def _limiter(self, url: str) -> RateLimiter:
+        '''Returns the rate limiter shared by all the requests to the host of the provided url.'''
+
+        host = urlparse(url).hostname
+        with self._host_semaphores_lock:
+            if host not in self._limiters:
+                rate, burst = self.host_rates.get(host, self.default_host_rate)
+                self._limiters[host] = RateLimiter(host, rate, burst, report=self._print)
+            return self._limiters[host]
+
+
+    def _send_with_retries(self, url: str, headers: dict[str,str], acceptable_codes: list) -> requests.Response:
+        '''Perform streamed request with retries if the request status code is not in the provided list and return the
+        response without reading its body. The caller must hold a connection slot for the host.
+        Requests are paced by the rate limiter of the host, 429 and 5xx responses are retried with jittered exponential
+        backoff (or after `Retry-After`), and permanent status codes fail straight away.'''
+
+        limiter = self._limiter(url)
+        host = limiter.host
+        attempt = 0
+        while True:
+            try:
+                with self.metrics.stage("request_wait"):
+                    limiter.acquire()
+                with self.metrics.stage("transfer"):
+                    r = self.session.get(url, headers=headers, stream=True)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                self.metrics.add_response(host, 0, retry=True)
+                time.sleep(limiter.backoff(attempt))
+                attempt += 1
+                continue
+
+            limiter.update(r.headers)
+            retry = r.status_code not in acceptable_codes and r.status_code not in self.permanent_codes and attempt < self.retries
+            self.metrics.add_response(host, r.status_code, retry)
+            if r.status_code in acceptable_codes:
+                return r
+            r.close()
+
+            if r.status_code in self.permanent_codes or attempt >= self.retries:
+                raise ConnectionError(f"Response status code {r.status_code} not in list.")
+
+            delay = parse_retry_after(r.headers.get("Retry-After"))
+            if delay is not None:
+                limiter.pause(delay)
+            elif r.status_code == 429:
+                limiter.pause(limiter.backoff(attempt))
+            else:
+                time.sleep(limiter.backoff(attempt))
+            attempt += 1
+
+
     def _get_request_with_retries(self, url: str, headers: dict[str,str], acceptable_codes: list) -> requests.Response | None:
-        '''Perform request with retries if the request status code is not in the provided list and return the response.'''
-
-        retries = self.retries
-        r = self.session.get(url, headers=headers, stream=True)
-        while retries and r.status_code not in acceptable_codes:
-            retries -= 1
-            time.sleep(2 - random.random())
-            r = self.session.get(url, headers=headers, stream=True)
-        if r.status_code not in acceptable_codes:
-            raise ConnectionError("Response status code not in list.")
+        '''Perform request with retries if the request status code is not in the provided list and return the response.
+        The response body is read while holding a connection slot for the host, so the per-host limits also cover the transfer.'''
+
+        with self._host_slot(url):
+            r = self._send_with_retries(url, headers, acceptable_codes)
+            with self.metrics.stage("transfer"):
+                self.metrics.add_bytes(urlparse(url).hostname, len(r.content))
+            self._throttle(len(r.content))
         return r
-    
 
-    def _get_image(self, img_url: str, id: str, title: str, author, url: str) -> None:
-        '''Gets and saves the Image files. Files other than .gif are saved as .jpg in order to add metadata.'''
 
-        img_data = self._get_request_with_retries(img_url, self.headers["headers_img"], [200])
-        
-        # Gif exception, can't save as .jpg and does not support metadata.
-        img_extension = img_url.split(".")[-1]
-        if img_extension.lower() == "gif":
-            filepath  = self.image_path / f'{id}.gif'
-            
+    def _throttle(self, size: int) -> float:
+        '''Waits as needed to keep the overall download speed under `max_bytes_per_sec`. Returns the seconds waited.'''
+
+        if self._bandwidth is None:
+            return 0.0
+        waited = self._bandwidth.consume(size)
+        if waited:
+            self.metrics.add_time("request_wait", waited)
+        return waited
+
+
+    @contextmanager
+    def _stream_request(self, url: str, headers: dict[str,str], acceptable_codes: list):
+        '''Context manager yielding a response whose body has not been read yet. The connection slot for the host
+        is held until the context exits, and the response is closed afterwards.'''
+
+        with self._host_slot(url):
+            r = self._send_with_retries(url, headers, acceptable_codes)
+            try:
+                yield r
+            finally:
+                r.close()
+
+
+    def _download_range(self, url: str, headers: dict[str,str], filepath: Path, start: int, end: int, total_size: int) -> None:
+        '''Downloads the inclusive byte range of the url and writes it at its offset in the (preallocated) file.
+        The `Content-Range` of the response is checked against the requested range and the expected file size.'''
+
+        headers = {**headers, "Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+        written = 0
+        disk_seconds = 0.0
+        wait_seconds = 0.0
+        with self._stream_request(url, headers, [206]) as r:
+            content_range = r.headers.get("Content-Range", "")
+            if content_range and content_range != f"bytes {start}-{end}/{total_size}":
+                raise ConnectionError(f"Unexpected Content-Range '{content_range}' for bytes={start}-{end}/{total_size}.")
+            transfer_start = time.perf_counter()
+            with open(filepath, "r+b") as file:
+                file.seek(start)
+                for chunk in r.iter_content(chunk_size=self.stream_chunk_size):
+                    wait_seconds += self._throttle(len(chunk))
+                    write_start = time.perf_counter()
+                    file.write(chunk)
+                    disk_seconds += time.perf_counter() - write_start
+                    written += len(chunk)
+            self.metrics.add_time("transfer", time.perf_counter() - transfer_start - disk_seconds - wait_seconds)
+            self.metrics.add_time("disk_write", disk_seconds)
+            self.metrics.add_bytes(urlparse(url).hostname, written)
+
+        if written != end - start + 1:
+            raise ConnectionError(f"Incomplete range bytes={start}-{end}, got {written} bytes.")
+
+
+    def _download_file(self, url: str, headers: dict[str,str], filepath: Path) -> None:
+        '''Downloads the whole url streaming it straight to the file.'''
+
+        written = 0
+        disk_seconds = 0.0
+        wait_seconds = 0.0
+        with self._stream_request(url, headers, [200]) as r:
+            transfer_start = time.perf_counter()
+            with open(filepath, "wb") as file:
+                for chunk in r.iter_content(chunk_size=self.stream_chunk_size):
+                    wait_seconds += self._throttle(len(chunk))
+                    write_start = time.perf_counter()
+                    file.write(chunk)
+                    disk_seconds += time.perf_counter() - write_start
+                    written += len(chunk)
+            self.metrics.add_time("transfer", time.perf_counter() - transfer_start - disk_seconds - wait_seconds)
+            self.metrics.add_time("disk_write", disk_seconds)
+            self.metrics.add_bytes(urlparse(url).hostname, written)
+
+
+    def _download_segmented(self, url: str, headers: dict[str,str], filepath: Path, total_size: int) -> None:
+        '''Downloads the file in byte ranges that are fetched in parallel and streamed straight to their offset in a
+        preallocated file, so memory use does not depend on the size of the file.
+        Completed ranges are recorded in a resume journal, so a restarted download only requests the missing ranges.'''
+
+        if total_size > self.vid_size_cutoff:
+            expected = [(start, min(start + self.vid_chunk_size, total_size) - 1) for start in range(0, total_size, self.vid_chunk_size)]
         else:
-            filepath  = self.image_path / f'{id}.jpg'
+            expected = [(0, total_size - 1)]
 
-        i = 1
-        while True:
-            if not Path(filepath).exists():
-                break
-            if img_extension.lower() == "gif":
-                filepath = self.image_path / f'{id}({i}).gif'
-            else:
-                filepath = self.image_path / f'{id}({i}).jpg'
-            i += 1
+        ranges = expected
+        journal = ResumeJournal(filepath, url, total_size, self.vid_chunk_size)
+        if journal.load():
+            ranges = [item for item in expected if item not in journal.completed]
+        else:
+            # No usable partial download, start from an empty preallocated file.
+            with open(filepath, "wb") as file:
+                file.truncate(total_size)
+
+        post_id = self.metrics.current_post
+
+        def download(start: int, end: int) -> None:
+            with self.metrics.bind(post_id):
+                self._download_range(url, headers, filepath, start, end, total_size)
+                journal.mark_done(start, end)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.segment_workers)) as executor:
+            futures = [executor.submit(download, start, end) for start, end in ranges]
+            for future in futures:
+                future.result()
+
+        # The file is preallocated, so its size says nothing, every range has to be recorded as written.
+        missing = [item for item in expected if item not in journal.completed]
+        if missing:
+            raise ConnectionError(f"Download incomplete, {len(missing)} of {len(expected)} ranges missing.")
+        journal.remove()
+
+
+    def _image_candidates(self, original_url: str, original_width: int | None, renditions: list[tuple[int, str]]) -> list[str]:
+        '''Returns the urls of the image to try in order, according to the image size policy. Without limits only the
+        original image is downloaded, otherwise the renditions (width, url) no wider than `max_image_width` are
+        returned from the largest to the smallest, the smallest one being used if none fits.'''
+
+        if self.max_image_width is None and self.max_image_bytes is None:
+            return [original_url]
+        if urlparse(original_url).path.lower().endswith(".gif"):
+            return [original_url]  # The renditions of an animated image are still images.
+
+        candidates = sorted(renditions, reverse=True)
+        if original_width:
+            # The full size preview is a re-encoded copy of the original.
+            candidates = [(original_width, original_url)] + [item for item in candidates if item[0] < original_width]
+        if not candidates:
+            return [original_url]
+        if self.max_image_width is not None:
+            fitting = [item for item in candidates if item[0] <= self.max_image_width]
+            candidates = fitting or candidates[-1:]
+        return [url for _, url in candidates]
+
+
+    def _fetch_image(self, img_urls: list[str]) -> tuple[str, bytes]:
+        '''Downloads the first image of the candidates whose size is within `max_image_bytes`, checking the
+        `Content-Length` before reading the body. The last candidate is always accepted.
+        Returns the url that was downloaded and its content.'''
+
+        for position, img_url in enumerate(img_urls):
+            host = urlparse(img_url).hostname
+            headers = {**self.headers["headers_img"], "Host": host}
+            with self._stream_request(img_url, headers, [200]) as r:
+                size = r.headers.get("Content-Length")
+                if (position < len(img_urls) - 1 and self.max_image_bytes is not None and size is not None
+                        and int(size) > self.max_image_bytes):
+                    continue
+                chunks = []
+                wait_seconds = 0.0
+                transfer_start = time.perf_counter()
+                for chunk in r.iter_content(chunk_size=self.stream_chunk_size):
+                    wait_seconds += self._throttle(len(chunk))
+                    chunks.append(chunk)
+                content = b"".join(chunks)
+                self.metrics.add_time("transfer", time.perf_counter() - transfer_start - wait_seconds)
+                self.metrics.add_bytes(host, len(content))
+            return img_url, content
+
+
+    def _get_image(self, img_urls: list[str], id: str, title: str, author, url: str, number: int = 0) -> tuple[Path, int]:
+        '''Gets and saves the Image files and returns the path and size of the saved file. The first candidate url that fits
+        the image size policy is downloaded. Images of a gallery are numbered, as `id(number)`.
+        Files other than .gif are saved as .jpg in order to add metadata.'''
+
+        img_url, content = self._fetch_image(img_urls)
+        name = id if number == 0 else f'{id}({number})'
 
+        # Gif exception, can't save as .jpg and does not support metadata.
+        img_extension = Path(urlparse(img_url).path).suffix.lstrip(".")
         if img_extension.lower() == "gif":
-            with open(filepath, "wb") as file:
-                file.write(img_data.content)
-            return
+            filepath = self.image_path / f'{name}.gif'
+            return filepath, self._store_bytes(content, filepath, id)
 
-        im = Image.open(BytesIO(img_data.content)).convert("RGB")
-        exif = im.getexif()
+        filepath = self.image_path / f'{name}.jpg'
         comment = '{{"title": "{title}", "url": "{url}", "author": "{author}", "id": "{id}"}}'.format(title=title, url=url, author=author, id=id)
-        exif[270] = title
-        exif[40092] = comment.encode("utf-16")
-        im.save(filepath, exif=exif)
+        data = None
+        if is_jpeg(content):
+            # Already a JPEG, only the EXIF segment is rewritten.
+            try:
+                with self.metrics.stage("image_processing"):
+                    data = inject_exif(content, title, comment)
+            except ValueError:
+                pass
+        if data is None:
+            # Other formats need to be decoded and re-encoded, which runs in the process pool.
+            with self.metrics.stage("image_processing"):
+                if self._image_executor is None:
+                    data = convert_to_jpeg(content, title, comment)
+                else:
+                    data = self._image_executor.submit(convert_to_jpeg, content, title, comment).result()
 
+        return filepath, self._store_bytes(data, filepath, id)
 
-    def _get_video(self, video_url, audio_url, id, title, author, url) -> None:
-        '''Gets and saves the video and audio files, combines them, removes temporary files and adds metadata.'''
 
-        # Resetting headers.
-        self.headers["headers_video"]["Range"] = ""
-        self.headers["headers_audio"]["Range"] = "bytes=0-899"
-        
-        # Just in case files are leftover from a failed attempt.
-        if Path(self.video_path / f"_vid-{id}.mp4").exists():
-            os.remove(self.video_path / f"_vid-{id}.mp4")
-        if Path(self.video_path / f"_audio-{id}.mp4").exists():
-            os.remove(self.video_path / f"_audio-{id}.mp4")
-        
-        # Get info on video content length.
-        r_vid_info = self._get_request_with_retries(video_url, self.headers["headers_info"], [206])
+    def _store_bytes(self, data: bytes, filepath: Path, post_id: str) -> int:
+        '''Adds the content to the media store (once per distinct content) and links it at the path, or adds it to the
+        shards under that path in packed mode. Returns the size of the content.'''
+
+        with self.metrics.stage("disk_write"):
+            if self.packed_archive is not None:
+                size, _ = self.packed_archive.add(post_id, filepath.relative_to(self.path).as_posix(), data)
+                return size
+            digest, blob = self.media_store.put(data, filepath.suffix)
+            self.media_store.link(digest, blob, filepath)
+        return len(data)
 
-        max_vid = int(r_vid_info.headers["Content-Length"])
 
-        # Get video file in chunks or all at once depending on size.
-        if max_vid > self.vid_size_cutoff:
-            parts = max_vid // self.vid_chunk_size
-            for part in range(parts + 1):
-                start = part * self.vid_chunk_size + 1 if part > 0 else 0
-                end = (part+1) * self.vid_chunk_size if (part+1) * self.vid_chunk_size < max_vid else max_vid
-                self.headers["headers_video"]["Range"] = f"bytes={start}-{end}"
+    def _store_file(self, source_path: Path, filepath: Path, post_id: str) -> int:
+        '''Moves the finished file into the media store and links it at the path, or adds it to the shards under that
+        path in packed mode and removes it. Returns the size of the file.'''
 
-                # Get video file.
-                r_video = self._get_request_with_retries(video_url, self.headers["headers_video"], [206])
+        with self.metrics.stage("disk_write"):
+            if self.packed_archive is not None:
+                size, _ = self.packed_archive.add(post_id, filepath.relative_to(self.path).as_posix(), source_path)
+                os.remove(source_path)
+                return size
+            size = source_path.stat().st_size
+            digest, blob = self.media_store.put_file(source_path, filepath.suffix)
+            self.media_store.link(digest, blob, filepath)
+        return size
 
-                with open(self.video_path / f"_video-{id}.mp4", "ab") as file:
-                    file.write(r_video.content)
+
+    def _archived_size(self, filepath: Path) -> int | None:
+        '''Returns the size of the file saved at the path (in the shards in packed mode), None if there is none.'''
+
+        if self.packed_archive is not None:
+            entry = self.packed_archive.get(filepath.relative_to(self.path).as_posix())
+            return entry["size"] if entry is not None else None
+        try:
+            return filepath.stat().st_size
+        except OSError:
+            return None
+
+
+    def _get_gif(self, gif_url: str, mp4_url: str | None, id: str, title: str, author, url: str, number: int = 0) -> tuple[Path, int]:
+        '''Saves the GIF as an mp4 file with the same metadata as videos and returns its path and size. The mp4 variant listed
+        by Reddit is downloaded if there is one, otherwise the GIF is transcoded. Both run FFMPEG in the mux pool.
+        If FFMPEG fails, the downloaded file is kept as it is, without metadata.'''
+
+        name = id if number == 0 else f'{id}({number})'
+        filepath = self.image_path / f'{name}.mp4'
+        source_url = mp4_url or gif_url
+        source_path = self.media_store.temp_path(".mp4" if mp4_url else ".gif")
+        output_path = self.media_store.temp_path(".mp4")
+        self._download_file(source_url, {**self.headers["headers_img"], "Host": urlparse(source_url).hostname}, source_path)
+
+        comment = "{{'title': '{title}', 'url': '{url}', 'author': '{author}', 'id': '{id}'}}".format(title=title, url=url, author=author, id=id)
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", str(source_path)]
+        if mp4_url:
+            command += ["-map", "0", "-c", "copy"]
         else:
-            self.headers["headers_video"]["Range"] = f"bytes=0-{max_vid}"
+            # Most players need even dimensions and yuv420p.
+            command += ["-movflags", "+faststart", "-pix_fmt", "yuv420p", "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2"]
+        command += ["-metadata", f"title={title}", "-metadata", f"comment={comment}", str(output_path)]
+
+        with self.metrics.stage("ffmpeg_mux"):
+            if self._mux_executor is None:
+                returncode = self._run_ffmpeg(command)
+            else:
+                returncode = self._mux_executor.submit(self._run_ffmpeg, command).result()
+
+        if returncode != 0:
+            if output_path.exists():
+                os.remove(output_path)
+            filepath = filepath.with_suffix(source_path.suffix)
+            self._print(f"FFMPEG error, saving '{filepath.name}' without metadata.")
+            return filepath, self._store_file(source_path, filepath, id)
+        os.remove(source_path)
+        return filepath, self._store_file(output_path, filepath, id)
 
-            # Get video file.
-            r_video = self._get_request_with_retries(video_url, self.headers["headers_video"], [206])
 
-            with open(self.video_path / f"_video-{id}.mp4", "wb") as file:
-                file.write(r_video.content)
+    def _run_ffmpeg(self, command: list[str]) -> int:
+        '''Runs FFMPEG and returns its exit code, -1 if it is not installed.'''
 
-        # No Audio.
-        if not audio_url:
+        try:
+            return subprocess.run(command).returncode
+        except OSError:
+            return -1
+
+
+    def _probe_size(self, video_url: str) -> int:
+        '''Returns the size of the video stream, from the `Content-Range` of a request for its first byte.'''
+
+        with self._stream_request(video_url, {**self.headers["headers_info"], "Range": "bytes=0-0"}, [206]) as r_vid_info:
+            return int(r_vid_info.headers["Content-Range"].split("/")[1])
+
+
+    def _select_streams(self, reddit_video: dict) -> tuple[str, list[str]]:
+        '''Returns the url of the video stream to download and the candidate urls of its audio stream (empty if the
+        video has no audio). The streams are picked from the DASH playlist of the video within the `max_video_height`,
+        `max_video_bitrate` and `max_video_bytes` limits. If the playlist cannot be read, the fallback url is used and
+        the audio url is guessed from the current and older naming schemes.'''
+
+        dash_url = reddit_video.get("dash_url")
+        if dash_url:
+            headers = {key: value for key, value in self.headers["headers_video"].items() if key != "Range"}
             try:
-                os.rename(self.video_path / f"_video-{id}.mp4", self.video_path / f"_{id}.mp4")
-            except FileExistsError:
-                replace = input(f"File '{id}.mp4' already exists. Overwrite? [y/N] ")
-                if replace.lower() == "y":
-                    os.remove(self.video_path / f"_{id}.mp4")
-                    os.rename(self.video_path / f"_video-{id}.mp4", self.video_path / f"_{id}.mp4")
-                else:
-                    os.remove(self.video_path / f"_video-{id}.mp4")
+                r = self._get_request_with_retries(dash_url, headers, [200])
+                duration, representations = parse_mpd(r.content, dash_url.split("?")[0])
+                video, audio = select_representations(
+                    representations, duration, self.max_video_height, self.max_video_bitrate, self.max_video_bytes
+                )
+                return video["url"], [audio["url"]] if audio is not None and reddit_video.get("has_audio", True) else []
+            except (ConnectionError, requests.RequestException, ValueError):
+                pass
+
+        video_url = reddit_video["fallback_url"].split("?")[0]
+        if not reddit_video.get("has_audio"):
+            return video_url, []
+        base_url = video_url.rsplit("/", 1)[0]
+        return video_url, [f"{base_url}/DASH_AUDIO_128.mp4", f"{base_url}/audio"]
+
+
+    def _get_video(self, reddit_video: dict, id, title, author, url) -> None:
+        '''Gets and saves the video and audio files, then combines them and adds metadata in the mux pool.'''
+
+        filepath = self.video_path / f"{id}.mp4"
+        size = self._archived_size(filepath)
+        if size is not None and self.existing_videos != "overwrite":
+            # Never prompt from a worker thread, the existing video is kept as it is.
+            self._print(f"File '{id}.mp4' already exists, skipping.")
+            self._record_archived(id, "video", [(filepath, size)])
+            self.metrics.add_post(id, "video", archived=True)
             return
 
-        # Get info on audio content length.
-        r_aud_info = self._get_request_with_retries(audio_url, self.headers["headers_audio"], [206, 403])
-        if r_aud_info.status_code == 403:
-            audio_url = audio_url.replace("AUDIO_128", "audio")  # Older format.
-            time.sleep(2)
-            r_aud_info = self._get_request_with_retries(audio_url, self.headers["headers_audio"], [206])
-        
-        max_aud = int(r_aud_info.headers["Content-Range"].split("/")[1])
+        video_url, audio_urls = self._select_streams(reddit_video)
 
-        # Get audio file in chunks or all at once depending on size.
-        if max_aud > self.vid_size_cutoff:
-            parts = max_aud // self.vid_chunk_size
-            for part in range(parts + 1):
-                start = part * self.vid_chunk_size + 1 if part > 0 else 0
-                end = (part+1) * self.vid_chunk_size if (part+1) * self.vid_chunk_size < max_aud else max_aud
-                self.headers["headers_audio"]["Range"] = f"bytes={start}-{end}"
+        # Files left over from a failed attempt are resumed (or overwritten) by the segmented download.
+        max_vid = self._probe_size(video_url)
 
-                # Get video file.
-                r_audio = self._get_request_with_retries(audio_url, self.headers["headers_audio"], [206])
+        # Get video file in parallel ranges.
+        self._download_segmented(video_url, self.headers["headers_video"], self.video_path / f"_video-{id}.mp4", max_vid)
 
-                with open(self.video_path / f"_audio-{id}.mp4", "ab") as file:
-                    file.write(r_audio.content)
-        else:
-            self.headers["headers_audio"]["Range"] = f"bytes=0-{max_aud}"
+        audio_path = None
+        for position, audio_url in enumerate(audio_urls):
+            # Get info on audio content length, only guessed urls may not exist.
+            last = position == len(audio_urls) - 1
+            with self._stream_request(audio_url, self.headers["headers_audio"], [206] if last else [206, 403]) as r_aud_info:
+                if r_aud_info.status_code != 206:
+                    continue
+                max_aud = int(r_aud_info.headers["Content-Range"].split("/")[1])
 
-            # Get audio file.
-            r_audio = self._get_request_with_retries(audio_url, self.headers["headers_audio"], [206])
+            # Get audio file in parallel ranges.
+            audio_path = self.video_path / f"_audio-{id}.mp4"
+            self._download_segmented(audio_url, self.headers["headers_audio"], audio_path, max_aud)
+            break
 
-            with open(self.video_path / f"_audio-{id}.mp4", "wb") as file:
-                file.write(r_audio.content)
+        comment = "{{'title': '{title}', 'url': '{url}', 'author': '{author}', 'id': '{id}'}}".format(title=title, url=url, author=author, id=id)
+        mux_args = (id, self.video_path / f"_video-{id}.mp4", audio_path, filepath, title, comment)
 
-        try:
-            # Combine video and audio files.
-            subprocess.run(
-                f'ffmpeg -hide_banner -loglevel error -i "{self.video_path}\_video-{id}.mp4" -i "{self.video_path}\_audio-{id}.mp4" -map "0:0" -map "1:0" -c copy "{self.video_path}\_{id}.mp4"'
-            )
-
-            # Remove temporary files. 
-            os.remove(self.video_path / f"_video-{id}.mp4")
-            os.remove(self.video_path / f"_audio-{id}.mp4")
-        except:
+        # Muxing runs in the background pool so the download worker can move on to the next post.
+        if self._mux_executor is None:
+            self._mux_video(*mux_args)
+        else:
+            future = self._mux_executor.submit(self._mux_video, *mux_args)
+            future.add_done_callback(lambda f: self._mux_done(f, id, url))
+
+
+    def _mux_video(self, id: str, video_path: Path, audio_path: Path | None, filepath: Path, title: str, comment: str) -> None:
+        '''Combines the video and audio files and adds the metadata in a single FFMPEG pass, then moves the result
+        into the media store and links it at the final path (or packs it). The temporary files are removed and the post is indexed and
+        counted as archived on success, and the temporary files are left in place on failure.'''
+
+        output_path = self.media_store.temp_path(".mp4")
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", str(video_path)]
+        if audio_path is not None:
+            command += ["-i", str(audio_path), "-map", "0:0", "-map", "1:0"]
+        command += ["-c", "copy", "-metadata", f"title={title}", "-metadata", f"comment={comment}", str(output_path)]
+
+        with self.metrics.bind(id), self.metrics.stage("ffmpeg_mux"):
+            returncode = self._run_ffmpeg(command)
+        if returncode != 0:
+            if output_path.exists():
+                os.remove(output_path)
             raise Exception("FFMPEG error, leaving separate video and audio files.")
-        
-        try:
-            # Add metadata to video file.
-            comment = "{{'title': '{title}', 'url': '{url}', 'author': '{author}', 'id': '{id}'}}".format(title=title, url=url, author=author, id=id)
-            subprocess.run(
-                f'ffmpeg -hide_banner -loglevel error -i "{self.video_path}\_{id}.mp4" -c copy -metadata title="{title}" -metadata comment="{comment}" "{self.video_path}\{id}.mp4"'
-            )
-            os.remove(self.video_path / f"_{id}.mp4")
-        except:
-            if Path(self.video_path / f"_{id}.mp4").exists():
-                os.rename(self.video_path / f"_{id}.mp4", self.video_path / f"{id}.mp4")
-            raise Exception("FFMPEG error, can't add metadata.")
+        with self.metrics.bind(id):
+            size = self._store_file(output_path, filepath, id)
+
+        # Remove temporary files.
+        os.remove(video_path)
+        if audio_path is not None:
+            os.remove(audio_path)
+        self._record_archived(id, "video", [(filepath, size)])
+        self.metrics.add_post(id, "video", archived=True)
+
+
+    def _mux_done(self, future, id: str, link: str) -> None:
+        '''Reports errors of a finished background mux job, counting the post as failed.'''
+
+        e = future.exception()
+        if e is not None:
+            self._print(f"Error merging video of '{link}'. Please check 'error.log' for details.")
+            self._log_error(link, e)
+            self.metrics.add_post(id, "video", archived=False)
 
 
     def _determine_post_type(self, post: dict) -> str:
@@ -339,93 +776,129 @@ class RedditSPD:
         return "link"
 
 
-    def _get_content(self, post: dict) -> None:
-        '''Gets the content from the post and saves it according to it's type.'''
+    def _get_content(self, post: dict) -> tuple[str, list[tuple[Path, int]] | None]:
+        '''Gets the content from the post and saves it according to it's type. Comments, links and self posts are
+        stored as records by the buffered writers. Returns the post type and the files written for the post with
+        their sizes, or None for posts that are indexed later (records once written, videos once merged).'''
 
         post_type = self._determine_post_type(post)
+        files = []
         
         if post_type == "gallery":
-            img_list = post["data"]["media_metadata"].keys()
-            for img_id in img_list:
-                img_extension = post["data"]["media_metadata"][img_id]["m"].split("/")[1]
-                img_url= f'https://i.redd.it/{img_id}.{img_extension}'
-                id = post["data"]["id"]
-                title = post["data"]["title"]
-                author = post["data"]["author"]
-                url = f'https://reddit.com{post["data"]["permalink"]}'
-                self._get_image(img_url, id, title, author, url)
-        
-        if post_type == "image":
-            img_url= post["data"]["url"]
             id = post["data"]["id"]
             title = post["data"]["title"]
             author = post["data"]["author"]
             url = f'https://reddit.com{post["data"]["permalink"]}'
-            self._get_image(img_url, id, title, author, url)
+            post_id = self.metrics.current_post
+
+            def get_gallery_image(number: int, img_id: str) -> tuple[Path, int]:
+                media = post["data"]["media_metadata"][img_id]
+                img_extension = media["m"].split("/")[1]
+                img_url = f'https://i.redd.it/{img_id}.{img_extension}'
+                if img_extension.lower() == "gif" and self.gif_policy == "mp4":
+                    mp4_url = media.get("s", {}).get("mp4")
+                    with self.metrics.bind(post_id):
+                        return self._get_gif(img_url, html.unescape(mp4_url) if mp4_url else None, id, title, author, url, number)
+                renditions = [(item["x"], html.unescape(item["u"])) for item in media.get("p", []) if "u" in item]
+                original_width = media.get("s", {}).get("x")
+                with self.metrics.bind(post_id):
+                    return self._get_image(self._image_candidates(img_url, original_width, renditions), id, title, author, url, number)
+
+            # Gallery order if available, missing images are left out.
+            img_ids = [item["media_id"] for item in (post["data"].get("gallery_data") or {}).get("items", [])]
+            img_ids = [img_id for img_id in img_ids if img_id in post["data"]["media_metadata"]] or list(post["data"]["media_metadata"])
+
+            # The images of a gallery are fetched concurrently, within the connection limits of the hosts.
+            with ThreadPoolExecutor(max_workers=max(1, self.gallery_workers)) as executor:
+                futures = [executor.submit(get_gallery_image, number, img_id) for number, img_id in enumerate(img_ids)]
+                for future in futures:
+                    files.append(future.result())
 
-        if post_type == "self":
+        if post_type == "image":
+            img_url= post["data"]["url"]
             id = post["data"]["id"]
             title = post["data"]["title"]
             author = post["data"]["author"]
-            url = post["data"]["url"]
-            content = post["data"]["selftext"]
-            with open(self.selfpost_path / f'{id}.txt', "w") as file:
-                content = f'{title = }\n{author = }\n{url = }\n\n{content}'
-                file.write(content)
+            url = f'https://reddit.com{post["data"]["permalink"]}'
+            renditions = []
+            original_width = None
+            preview_images = (post["data"].get("preview") or {}).get("images") or []
+            if preview_images:
+                renditions = [(item["width"], html.unescape(item["url"])) for item in preview_images[0].get("resolutions", [])]
+                original_width = preview_images[0].get("source", {}).get("width")
+            if urlparse(img_url).path.lower().endswith(".gif") and self.gif_policy == "mp4":
+                mp4_url = None
+                if preview_images:
+                    mp4_url = preview_images[0].get("variants", {}).get("mp4", {}).get("source", {}).get("url")
+                files.append(self._get_gif(img_url, html.unescape(mp4_url) if mp4_url else None, id, title, author, url))
+            else:
+                files.append(self._get_image(self._image_candidates(img_url, original_width, renditions), id, title, author, url))
+
+        if post_type in ("self", "comment", "link"):
+            self._add_record(post_type, post)
+            files = None
 
         if post_type == "video":
             id = post["data"]["id"]
             title = post["data"]["title"]
             author = post["data"]["author"]
             url = f'https://reddit.com{post["data"]["permalink"]}'
-            video_url = post["data"]["secure_media"]["reddit_video"]["fallback_url"][:-16]
-            has_audio = post["data"]["secure_media"]["reddit_video"]["has_audio"]
-            if has_audio:
-                audio_url = f"https://v.redd.it/{video_url.split('/')[3]}/DASH_AUDIO_128.mp4"
-            else:
-                audio_url = None
-            self._get_video(video_url, audio_url, id, title, author, url)
+            self._get_video(post["data"]["secure_media"]["reddit_video"], id, title, author, url)
+            files = None
 
-        if post_type == "comment":
-            title = post["data"]["link_title"]
-            author = post["data"]["author"]
-            body = post["data"]["body"]
-            url = post["data"]["link_permalink"]
+        return post_type, files
 
-            content = f'{title = }\n{author = }\n{url = }\n\n{body}\n\n{"-"*50}\n\n'
 
-            with open(self.path / "comments.txt", "a", encoding="utf-8") as file:
-                file.write(content)
+    def _add_record(self, post_type: str, post: dict) -> None:
+        '''Buffers the post in the record writer of its type. The post is only indexed once its batch has been
+        written to the file, so an interrupted run never indexes a record that was lost with the buffer.'''
 
-        if post_type == "link":
-            id = post["data"]["id"]
-            title = post["data"]["title"]
-            author = post["data"]["author"]
-            url = post["data"]["url"]
-            
-            content = f'{title = }\n{author = }\n{url = }\n\n{"-"*50}\n\n'
-            
-            with open(self.path / "link posts.txt", "a", encoding="utf-8") as file:
-                file.write(content)
+        writer = self.writers[post_type]
+        post_id = post["data"].get("id")
+
+        def written(size: int) -> None:
+            if post_id is not None:
+                self._record_archived(post_id, post_type, [(writer.filepath, size)])
+
+        with self.metrics.stage("disk_write"):
+            writer.add(post["data"], written)
     
 
     def _create_directory_struct(self) -> None:
         '''Creates the directory structured required to save all post types.'''
 
-        self.path = self.path / "Archive" /  self.username
+        self.path = self.root_path / "Archive" /  self.username
         self.path.mkdir(parents=True, exist_ok=True)
         self.image_path = self.path / "Images"
-        self.image_path.mkdir(exist_ok=True)
+        # An archive that was packed before keeps being packed.
+        packed = self.packed or (self.path / "Packed").is_dir()
+        if not packed:
+            self.image_path.mkdir(exist_ok=True)
         self.video_path = self.path / "Videos"
         self.video_path.mkdir(exist_ok=True)
         self.selfpost_path = self.path / "Self Posts"
         self.selfpost_path.mkdir(exist_ok=True)
+        self.index = ArchiveIndex(self.path / "archive.db")
+        # The store is shared by all the accounts in the archive, so media saved by several of them is only kept once.
+        names = {self.path / path: digest for path, digest in self.index.file_hashes().items()}
+        self.media_store = MediaStore(self.root_path / "Archive" / ".store", names)
+        if packed:
+            # Videos are still downloaded and merged as separate files in `Videos`, then packed once finished.
+            self.packed_archive = PackedArchive(self.path / "Packed", self.shard_size)
+        if self.use_listing_cache:
+            # One cache directory per account, so parallel batch processes never share one.
+            self.listing_cache = ListingCache(self.path / ".cache" / "listing", self.listing_cache_size)
+        self.writers = {
+            "comment": RecordWriter(self.path / "comments.jsonl.gz"),
+            "link": RecordWriter(self.path / "links.jsonl.gz"),
+            "self": RecordWriter(self.path / "self posts.jsonl.gz")
+        }
 
 
     def _login(self, username: str, password: str) -> requests.Response:
         '''Logs in on Reddit for the current session with the provided credentials.'''
 
-        self.headers["headers_login"]["Content-Length"] = str(41 + len(username) + len(password))
+        headers = {**self.headers["headers_login"], "Content-Length": str(41 + len(username) + len(password))}
         payload = {
             "op" : "login-main",
             "user" : f'{username}',
@@ -434,91 +907,610 @@ class RedditSPD:
         }
         login_url = f'https://old.reddit.com/api/login/{username}'
 
-        return self.session.post(login_url, data=payload, headers=self.headers["headers_login"])
+        with self._host_slot(login_url):
+            return self.session.post(login_url, data=payload, headers=headers)
 
 
-    def _get_saved_list(self) -> tuple[int, list[dict]]:
-        '''Returns the amount of saved posts and a list of the saved posts for the user.'''
+    def _slim_post(self, post: dict) -> dict:
+        '''Returns a copy of the post with only the fields needed to determine its type and get its content.
+        Comments, links and self posts are returned whole, as all their fields are stored in the records.'''
 
-        total_saved = 0
-        saved_list = []
+        if self._determine_post_type(post) in ("self", "comment", "link"):
+            # Stored as records, so every field of the listing is kept.
+            return {"kind": post.get("kind"), "data": post["data"]}
+
+        data = {key: post["data"][key] for key in self.post_fields if key in post["data"]}
+        if "secure_media" in data:
+            secure_media = data["secure_media"] or {}
+            data["secure_media"] = {"reddit_video": secure_media["reddit_video"]} if "reddit_video" in secure_media else secure_media
+        if "crosspost_parent_list" in data:
+            data["crosspost_parent_list"] = [self._slim_post({"data": parent})["data"] for parent in data["crosspost_parent_list"]]
+        return {"kind": post.get("kind"), "data": data}
+
+
+    def _get_listing_page(self, saved_url: str) -> bytes:
+        '''Returns the body of the listing page, revalidating the cached copy with a conditional request if there is one.'''
+
+        if self.listing_cache is None:
+            return self._get_request_with_retries(saved_url, self.headers["headers_saved"], [200]).content
+
+        headers = {**self.headers["headers_saved"], **self.listing_cache.conditional_headers(self.username, saved_url)}
+        r = self._get_request_with_retries(saved_url, headers, [200, 304])
+        if r.status_code == 304:
+            body = self.listing_cache.load(self.username, saved_url)
+            if body is not None:
+                return body
+            # The cached copy disappeared in the meantime, request the full page.
+            r = self._get_request_with_retries(saved_url, self.headers["headers_saved"], [200])
+        self.listing_cache.store(self.username, saved_url, r.headers, r.content)
+        return r.content
+
+
+    def _iter_saved_pages(self):
+        '''Yields the saved posts of the user one page at a time, as soon as each page arrives.
+        In incremental mode the pagination stops at the newest post of the last complete run (the `head` sync state
+        of the index), so posts that failed or were never reached in earlier runs are still listed.'''
+
+        head = self.index.get_state("head") if self.incremental and self.index is not None else None
+        listed = 0
         finished = False
         after = ""
         while not finished:
-            if total_saved == 0:
+            if listed == 0:
                 saved_url = f'https://old.reddit.com/user/{self.username}/saved.json'
             else:
-                saved_url = f'https://old.reddit.com/user/{self.username}/saved.json?count={total_saved}&after={after}'
-            saved_res = self._get_request_with_retries(saved_url, self.headers["headers_saved"], [200]).json()
+                saved_url = f'https://old.reddit.com/user/{self.username}/saved.json?count={listed}&after={after}'
+            with self.metrics.stage("listing"):
+                saved_res = json.loads(self._get_listing_page(saved_url))
             
-            saved_list += saved_res["data"]["children"]
-            total_saved += int(saved_res["data"]["dist"])
+            children = saved_res["data"]["children"]
+            if self._snapshot is not None:
+                for post in children:
+                    self._snapshot.add(post)
+            listed += int(saved_res["data"]["dist"])
             after = saved_res["data"]["after"]
             
             if after is None:
                 finished = True
 
-        return total_saved, saved_list
+            if head is not None:
+                for position, post in enumerate(children):
+                    if post["data"].get("id") == head:
+                        children = children[:position]
+                        finished = True
+                        break
+
+            yield [self._slim_post(post) for post in children]
+
+
+    def _iter_saved_posts(self, from_id: str | None = None, to_id: str | None = None):
+        '''Yields the saved posts of the user between the starting and ending post IDs, streaming the pages.
+        The pagination stops as soon as the ending post is reached.'''
+
+        pass_it = True if from_id is not None else False
+        for page in self._iter_saved_pages():
+            for post in page:
+                post_id = post["data"].get("id")
+                if post_id == from_id:
+                    pass_it = False
+
+                if not pass_it:
+                    yield post
+
+                if to_id is not None and post_id == to_id:
+                    return
+
+
+    def _record_archived(self, post_id: str, post_type: str, files: list[tuple[Path, int]]) -> None:
+        '''Adds the post and its files (relative to the user directory) with their sizes and the hashes of the media
+        in the store to the archive index.'''
+
+        if self.index is None:
+            return
+        entries = [
+            (filepath.relative_to(self.path).as_posix(), size, self._file_digest(filepath))
+            for filepath, size in files
+        ]
+        self.index.add(post_id, post_type, entries)
+
+
+    def _file_digest(self, filepath: Path) -> str | None:
+        '''Returns the sha256 hash of the media saved at the path, from the shards or the media store.'''
+
+        if self.packed_archive is not None:
+            entry = self.packed_archive.get(filepath.relative_to(self.path).as_posix())
+            if entry is not None:
+                return entry["sha256"]
+        return self.media_store.digest(filepath) if self.media_store else None
+
+
+    def _log_error(self, link: str, e: Exception) -> None:
+        '''Appends the details of the exception raised while getting the post at the link to the error log.
+        Each line names the account, as the processes of a batch run share the same log.'''
+
+        timestamp = datetime.now()
+        exception_name = type(e).__name__
+        exception_text = str(e)
+        
+        with self._log_lock:
+            with open("error.log", "a") as file:
+                file.write(f'[{timestamp}] [{self.username}]: {link} - {exception_name}: {exception_text}\n')
+
+
+    def _archive_post(self, index: int, post: dict) -> bool:
+        '''Gets the content of a single saved post, logging any error. Returns whether the post was archived.'''
+
+        # Saved comments have the title of their post instead.
+        title = post["data"].get("title", post["data"].get("link_title"))
+        self._print(f'Getting data from [{index + 1}] "{title}"...')
+        post_id = post["data"].get("id")
+        try:
+            with self.metrics.bind(post_id):
+                post_type, files = self._get_content(post)
+            if files is not None and post_id is not None:
+                self._record_archived(post_id, post_type, files)
+            if post_type != "video":
+                # Videos are counted once they are merged (or skipped).
+                self.metrics.add_post(post_id, post_type, archived=True)
+            return True
+        except Exception as e:
+            self._print(f"Error getting [{index + 1}] \"{title}\". Please check 'error.log' for details.")
+            if "permalink" in post["data"].keys():
+                link = post["data"]["permalink"]
+            else:
+                link = "N/A"
+            self._log_error(link, e)
+            self.metrics.add_post(post_id, self._determine_post_type(post), archived=False)
+            return False
+
+
+    def _estimate_size(self, post: dict, post_type: str) -> int:
+        '''Returns the approximate amount of bytes to download for the post, used to download small posts first.
+        Videos are estimated from the bitrate and duration listed in the post, or else from a size probe of the
+        video stream, other media from the `*_size_estimate` attributes.'''
+
+        data = post["data"]
+        if post_type == "gallery":
+            return len(data.get("media_metadata") or {}) * self.image_size_estimate
+        if post_type == "image":
+            if urlparse(data.get("url", "")).path.lower().endswith(".gif"):
+                return self.gif_size_estimate
+            return self.image_size_estimate
+        if post_type != "video":
+            return 0
+
+        reddit_video = (data.get("secure_media") or {}).get("reddit_video") or {}
+        if reddit_video.get("bitrate_kbps") and reddit_video.get("duration"):
+            return int(reddit_video["bitrate_kbps"] * 1000 / 8 * reddit_video["duration"])
+        if reddit_video.get("fallback_url"):
+            try:
+                return self._probe_size(reddit_video["fallback_url"].split("?")[0])
+            except (ConnectionError, requests.RequestException, KeyError, IndexError, ValueError):
+                pass
+        return self.video_size_estimate
+
+
+    def _download_worker(self, posts: queue.PriorityQueue) -> int:
+        '''Archives the posts taken from the queue until the end marker is reached, skipping the posts left once the
+        time limit is reached. Returns the amount archived.'''
+
+        archived = 0
+        while True:
+            _, index, post = posts.get()
+            if post is None:
+                return archived
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                self.metrics.add_skipped(post["data"].get("id"))
+                continue
+            archived += self._archive_post(index, post)
 
 
-    def start_dl(self, username: str, password: str, from_id: str | None = None, to_id: str | None = None) -> None:
+    def start_dl(self, username: str, password: str, from_id: str | None = None, to_id: str | None = None) -> bool:
         '''Starts the process of logging in, gathering the saved post pages and downloading 
-        the content of each saved post from newest to oldest saved.
+        the content of each saved post from newest to oldest saved. Returns False if the login failed.
+        The archive of each user is created under `root_path`, so the same instance can be reused for several users.
         '''
         
         self.username = username
+        self.metrics = Metrics()
         self._create_directory_struct()
 
         login_response = self._login(username, password)
         
         if login_response.status_code != 200:
             print("Error, cannot login! Please check provided credentials.")
+            self._close_archive()
+            return False
+
+        if self.save_snapshots:
+            # Raw copy of the listing, for re-processing the posts later without logging in.
+            snapshot_path = self.path / "Snapshots" / f'saved-{datetime.now().strftime("%Y%m%d-%H%M%S")}.jsonl.gz'
+            snapshot_path.parent.mkdir(exist_ok=True)
+            self._snapshot = RecordWriter(snapshot_path)
+
+        try:
+            self._run_posts(self._iter_saved_posts(from_id, to_id), from_id is None and to_id is None)
+        finally:
+            if self._snapshot is not None:
+                self._snapshot.flush()
+                self._snapshot = None
+        self._finish_run()
+        return True
+
+
+    def replay(self, username: str, snapshot: Path | None = None) -> bool:
+        '''Re-processes the saved posts of the user from the listing snapshots of earlier runs, without logging in.
+        The comment, link and self post records and the index are rebuilt offline, and only the media that is missing
+        from the archive is downloaded. All the snapshots are merged (the newest copy of each post wins) unless a single
+        snapshot is provided. Returns False if there is no snapshot.'''
+
+        self.username = username
+        self.metrics = Metrics()
+        self._create_directory_struct()
+
+        snapshots = [Path(snapshot)] if snapshot else sorted((self.path / "Snapshots").glob("saved-*.jsonl.gz"))
+        if not snapshots:
+            print(f'Error, no listing snapshot found for user "{username}".')
+            self._close_archive()
+            return False
+
+        self._run_posts(self._iter_replay_posts(snapshots), False)
+        self._finish_run()
+        return True
+
+
+    def _iter_replay_posts(self, snapshots: list[Path]):
+        '''Rebuilds the records from the snapshots, then yields the media posts whose files are missing from the archive.
+        Records of posts that are not in any of the snapshots are kept.'''
+
+        posts = {}
+        for snapshot in reversed(snapshots):
+            for post in read_records(snapshot):
+                posts.setdefault(post["data"].get("id"), post)
+
+        # The previous record files are kept aside until the new ones are complete.
+        kept = {}
+        for post_type, writer in self.writers.items():
+            old_path = writer.filepath.with_name(writer.filepath.name + ".old")
+            if not old_path.exists():
+                if writer.filepath.exists():
+                    os.replace(writer.filepath, old_path)
+            elif writer.filepath.exists():
+                os.remove(writer.filepath)  # Left over by an interrupted replay.
+            for record in read_unique_records(old_path):
+                if record.get("id") not in posts:
+                    kept[record.get("id")] = (post_type, record)
+        for post_type, record in kept.values():
+            self._add_record(post_type, {"data": record})
+
+        missing = []
+        for post in posts.values():
+            post = self._slim_post(post)
+            post_type = self._determine_post_type(post)
+            if post_type in ("self", "comment", "link"):
+                self._add_record(post_type, post)
+                continue
+
+            post_id = post["data"].get("id")
+            entry = self.index.get(post_id) if post_id is not None else None
+            if entry is not None and entry["files"] and all(self._archived_size(self.path / path) is not None for path, *_ in entry["files"]):
+                continue  # Media already in the archive.
+            if entry is not None:
+                self.index.remove(post_id)
+            missing.append(post)
+
+        for writer in self.writers.values():
+            writer.flush()
+            old_path = writer.filepath.with_name(writer.filepath.name + ".old")
+            if old_path.exists():
+                os.remove(old_path)
+        self._print(f'Records rebuilt from {len(snapshots)} snapshots, {len(missing)} posts with missing media.')
+        yield from missing
+
+
+    def audit(self, username: str, password: str | None = None, repair: bool = False) -> dict | None:
+        '''Checks the archive of the user: saved posts that were never archived, indexed files that are missing, truncated
+        or do not match their hash, and temporary files left over by interrupted downloads. The saved posts are listed
+        from Reddit if a password is provided, otherwise read from the listing snapshots. The files are checked in
+        parallel (`audit_workers`). With `repair`, the leftover temporary files are removed and only the missing and
+        damaged posts are downloaded again. Writes the report to `audit_report.json` and returns it, or None if the
+        login failed.'''
+
+        self.username = username
+        self.metrics = Metrics()
+        self._create_directory_struct()
+
+        if password is not None:
+            if self._login(username, password).status_code != 200:
+                print("Error, cannot login! Please check provided credentials.")
+                self._close_archive()
+                return None
+            # Every saved post is listed, even if the last run was incremental.
+            incremental, self.incremental = self.incremental, False
+            try:
+                saved = {post["data"].get("id"): post for post in self._iter_saved_posts()}
+            finally:
+                self.incremental = incremental
+        else:
+            saved = {}
+            for snapshot in sorted((self.path / "Snapshots").glob("saved-*.jsonl.gz"), reverse=True):
+                for post in read_records(snapshot):
+                    saved.setdefault(post["data"].get("id"), self._slim_post(post))
+
+        entries = self.index.files()
+        with ThreadPoolExecutor(max_workers=max(1, self.audit_workers)) as executor:
+            problems = list(executor.map(lambda entry: self._check_archived_file(*entry), entries))
+        damaged_files = [
+            {"post_id": post_id, "path": path, "problem": problem}
+            for (post_id, _, path, _, _), problem in zip(entries, problems) if problem is not None
+        ]
+        damaged = {item["post_id"] for item in damaged_files}
+        missing = [post_id for post_id in saved if post_id is not None and post_id not in self.index]
+
+        # Partial downloads of the posts that are going to be downloaded again are kept, so they can be resumed.
+        temp_files = []
+        for filepath in self._find_temp_files():
+            name = filepath.name
+            for prefix in ("_video-", "_audio-"):
+                if name.startswith(prefix) and name[len(prefix):].split(".")[0] in damaged.union(missing):
+                    break
+            else:
+                temp_files.append(filepath)
+
+        report = {
+            "checked_at": datetime.now().isoformat(timespec="seconds"),
+            "saved_posts": len(saved),
+            "indexed_posts": len(self.index),
+            "checked_files": len(entries),
+            "missing_posts": missing,
+            "damaged_files": damaged_files,
+            "temp_files": [str(filepath) for filepath in temp_files]
+        }
+        with open(self.path / "audit_report.json", "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+        print(f'Audit of "{username}": {len(entries)} files checked, {len(missing)} saved posts not archived, '
+              f'{len(damaged_files)} damaged files in {len(damaged)} posts, {len(temp_files)} leftover temporary files.')
+
+        if not repair:
+            self._close_archive()
+            self.username = ""
+            return report
+
+        for filepath in temp_files:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        for item in damaged_files:
+            self._remove_damaged_file(item["path"], item["problem"])
+        for post_id in damaged:
+            self.index.remove(post_id)
+        repairable = [saved[post_id] for post_id in missing + sorted(damaged) if post_id in saved]
+        if len(repairable) < len(missing) + len(damaged):
+            print(f'{len(missing) + len(damaged) - len(repairable)} damaged posts are no longer saved and cannot be downloaded again.')
+
+        self._run_posts(iter(repairable), False)
+        self._finish_run()
+        return report
+
+
+    def _check_archived_file(self, post_id: str, post_type: str, path: str, size: int, sha256: str | None) -> str | None:
+        '''Checks an indexed file, in the shards if it was packed. Record files are shared by many posts and grow
+        between runs, so only their presence is checked. Returns the problem found, see `check_file`.'''
+
+        if post_type in ("self", "comment", "link"):
+            return None if (self.path / path).exists() else "missing"
+        if self.packed_archive is not None and path in self.packed_archive:
+            entry = self.packed_archive.get(path)
+            if entry["size"] != size:
+                return "size"
+            return check_file(self.packed_archive.shard_dir / entry["shard"], size, sha256, entry["offset"])
+        return check_file(self.path / path, size, sha256)
+
+
+    def _remove_damaged_file(self, path: str, problem: str) -> None:
+        '''Removes a damaged media file before it is downloaded again, with its blob in the media store, as the blob holds
+        the same damaged content and would otherwise be linked again. Damaged packed files are only forgotten, until they
+        are added again.'''
+
+        if problem == "missing":
+            return
+        if self.packed_archive is not None and path in self.packed_archive:
+            self.packed_archive.discard(path)
             return
+        filepath = self.path / path
+        digest = self.media_store.digest(filepath)
+        for target in (filepath, self.media_store.blob_path(digest, filepath.suffix) if digest else None):
+            try:
+                if target is not None:
+                    os.remove(target)
+            except OSError:
+                pass
 
-        total_saved, saved_list = self._get_saved_list()
-        
-        print(f'{total_saved} saved posts located.')
-        
-        archive_counter = 0
-        pass_it = True if from_id is not None else False
-        
-        for index, post in enumerate(saved_list):
-            if "id" in post["data"].keys():
-                if post["data"]["id"] == from_id:
-                    pass_it = False
 
-            if not pass_it:
-                try:
-                    print(f'Getting data from [{index + 1}/{total_saved}] "{post["data"]["title"]}"...')
-                except KeyError:  # Saved comment.
-                    print(f'Getting data from [{index + 1}/{total_saved}] "{post["data"]["link_title"]}"...')
+    def _find_temp_files(self) -> list[Path]:
+        '''Returns the temporary files in the user archive and the media store: partial video and audio downloads with
+        their journals, unfinished links and unfinished store files.'''
+
+        temp_files = [filepath for filepath in self.video_path.glob("_*") if filepath.is_file()]
+        if self.image_path.is_dir():
+            temp_files += list(self.image_path.glob("_link-*"))
+        temp_files += list(self.media_store.temp_dir.iterdir())
+        return temp_files
+
+
+    def _run_posts(self, saved_posts, update_head: bool) -> None:
+        '''Downloads the posts from the iterable with the worker pool, skipping the posts that are already archived.
+        The writers are flushed and the index is closed when done. If `update_head` is set and every post was archived,
+        the newest post is stored as the point where the next incremental run can stop.'''
+
+        # Posts are handed to the workers through a bounded queue while the next pages are still being listed.
+        # The queue is ordered by the estimated size of the posts, so large videos do not hold up the small posts
+        # listed after them, and posts of the same size keep their saved order.
+        posts = queue.PriorityQueue(maxsize=max(1, self.queue_size))
+        workers = max(1, self.workers)
+        total_saved = 0
+        newest_id = None
+        listing_done = False
+        self._bandwidth = BandwidthLimiter(self.max_bytes_per_sec) if self.max_bytes_per_sec else None
+        self._deadline = time.monotonic() + self.time_limit if self.time_limit else None
+        self._mux_executor = ThreadPoolExecutor(max_workers=max(1, self.mux_workers))
+        self._image_executor = ProcessPoolExecutor(max_workers=max(1, self.image_workers))
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._download_worker, posts) for _ in range(workers)]
                 try:
-                    self._get_content(post)
-                    archive_counter += 1
-                except Exception as e:
-                    print("Error getting above post. Please check 'error.log' for details.")
-                    
-                    timestamp = datetime.now()
-                    if "permalink" in post["data"].keys():
-                        link = post["data"]["permalink"]
+                    for post in saved_posts:
+                        if newest_id is None:
+                            newest_id = post["data"].get("id")
+                        if post["data"].get("id") in self.index:
+                            continue  # Already archived.
+                        if self._deadline is not None and time.monotonic() >= self._deadline:
+                            self._print("Time limit reached, the remaining posts are left for the next run.")
+                            break
+                        posts.put((self._estimate_size(post, self._determine_post_type(post)), total_saved, post))
+                        total_saved += 1
                     else:
-                        link = "N/A"
-                    exception_name = type(e).__name__
-                    exception_text = str(e)
-                    
-                    with open("error.log", "a") as file:
-                        file.write(f'[{timestamp}]: {link} - {exception_name}: {exception_text}\n')
-                    
+                        listing_done = True
+                    self._print(f'{total_saved} saved posts located.')
+                finally:
+                    for marker in range(workers):
+                        posts.put((float("inf"), total_saved + marker, None))
+                for future in futures:
+                    future.result()
+        finally:
             try:
-                if post["data"]["id"] == to_id:
-                    break
-            except KeyError:
-                pass
-        
+                # Wait for the videos still being merged.
+                self._mux_executor.shutdown(wait=True)
+                self._mux_executor = None
+                self._image_executor.shutdown(wait=True)
+                self._image_executor = None
+
+                # Write the buffered records even if the run was interrupted, indexing them as they are written.
+                for writer in self.writers.values():
+                    writer.flush()
+                if self.export_text:
+                    export_text(self.path)
+
+                if (update_head and listing_done and newest_id is not None
+                        and not self.metrics.posts.get("failed") and not self.metrics.posts.get("skipped")):
+                    # Everything up to the newest saved post is archived, the next incremental run can stop there.
+                    self.index.set_state("head", newest_id)
+            finally:
+                self._close_archive()
+
+
+    def _close_archive(self) -> None:
+        '''Closes the index and the shards of the user archive. The writers must have been flushed.'''
+
+        self.writers = {}
+        if self.packed_archive is not None:
+            self.packed_archive.close()
+            self.packed_archive = None
+        self.index.close()
+        self.index = None
+
+
+    def _finish_run(self) -> None:
+        '''Prints and writes the summary of the run and resets the instance for the next user.'''
+
+        archive_counter = self.metrics.posts.get("archived", 0)
         print(f'Finished getting {archive_counter} saved posts for user "{self.username}".')
+        if self.metrics.posts.get("skipped"):
+            print(f'{self.metrics.posts["skipped"]} saved posts skipped because of the time limit.')
+        for host, limiter in self._limiters.items():
+            print(f'[{host}] {limiter.requests} requests, {limiter.sustained_rate():.2f} req/s sustained.')
+        self.metrics.write_summary(self.path / "run_summary.json")
+        if self.prometheus_path is not None:
+            self.metrics.write_prometheus(Path(self.prometheus_path), {"user": self.username})
         self.username = ""
+        self._bandwidth = None
+        self._deadline = None
         self.session.close()
-        self.session = requests.session()
+        self.session = self._new_session()
+
+
+_batch_slots = None
+
+
+def _init_batch_process(slots) -> None:
+    '''Stores the connection semaphore shared by the batch processes.'''
+
+    global _batch_slots
+    _batch_slots = slots
+
+
+def _batch_worker(root_path: str, settings: dict, account: dict) -> dict:
+    '''Downloads the saved posts of one account of a batch run, in its own process and session.
+    Returns the result and run summary of the account.'''
+
+    downloader = RedditSPD()
+    downloader.root_path = Path(account.get("path", root_path))
+    for key, value in settings.items():
+        setattr(downloader, key, value)
+    downloader.global_slots = _batch_slots
+
+    result = {"username": account["username"]}
+    try:
+        result["logged_in"] = downloader.start_dl(account["username"], account["password"], account.get("from_id"), account.get("to_id"))
+        result["summary"] = downloader.metrics.summary()
+    except Exception as e:
+        result["error"] = f'{type(e).__name__}: {e}'
+    return result
+
+
+def run_batch(config_path: Path, root_path: Path) -> dict:
+    '''Downloads the saved posts of all the accounts listed in the json config file, running the accounts in
+    parallel processes with a global cap on concurrent connections. Writes and returns the combined summary.
+
+    Config format: `{"processes": 4, "max_connections": 32, "settings": {"workers": 4, ...},
+    "accounts": [{"username": "...", "password": "...", "from_id": null, "to_id": null}, ...]}`'''
+
+    with open(config_path, "r", encoding="utf-8") as file:
+        config = json.load(file)
+
+    accounts = config["accounts"]
+    settings = config.get("settings", {})
+    defaults = RedditSPD()
+    for key in settings:
+        if not hasattr(defaults, key) or key.startswith("_"):
+            raise ValueError(f'Unknown setting "{key}".')
+    defaults.session.close()
+
+    processes = max(1, min(config.get("processes", os.cpu_count() or 1), len(accounts)))
+    slots = multiprocessing.BoundedSemaphore(config.get("max_connections", 32))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_process, initargs=(slots,)) as executor:
+        futures = [executor.submit(_batch_worker, str(root_path), settings, account) for account in accounts]
+        results = [future.result() for future in futures]
+
+    totals = {"archived": 0, "failed": 0, "bytes": 0}
+    for result in results:
+        summary = result.get("summary", {})
+        totals["archived"] += summary.get("posts", {}).get("archived", 0)
+        totals["failed"] += summary.get("posts", {}).get("failed", 0)
+        totals["bytes"] += sum(summary.get("bytes", {}).values())
+    combined = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "accounts": len(accounts),
+        "processes": processes,
+        **totals,
+        "results": results
+    }
+
+    summary_path = root_path / "Archive" / "batch_summary.json"
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(summary_path, "w", encoding="utf-8") as file:
+        json.dump(combined, file, indent=4)
+
+    print(f'Batch finished: {combined["archived"]} posts archived, {combined["failed"]} failed, for {len(accounts)} accounts '
+          f'in {combined["seconds"]}s. Summary saved to "{summary_path}".')
+    for result in results:
+        if "error" in result:
+            print(f'  {result["username"]}: {result["error"]}')
+        elif not result.get("logged_in"):
+            print(f'  {result["username"]}: cannot login.')
+    return combined
 
         
 if __name__ == "__main__":
@@ -526,15 +1518,63 @@ if __name__ == "__main__":
     downloader = RedditSPD()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-u", "--username", type=str, help="Reddit username.", required=True)
-    parser.add_argument("-p", "--password", type=str, help="Reddit password.", required=True)
+    parser.add_argument("-u", "--username", type=str, help="Reddit username.", required=False)
+    parser.add_argument("-p", "--password", type=str, help="Reddit password.", required=False)
+    parser.add_argument("-a", "--accounts", type=str, help="Json config file with several accounts to download in parallel (Optional).", required=False)
     parser.add_argument("-f", "--from_id", type=str, help="Reddit post id to start from (Optional).", required=False)
     parser.add_argument("-t", "--to_id", type=str, help="Reddit post id to end at. (Optional)", required=False)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of posts downloaded concurrently (Optional, default 1).", required=False)
+    parser.add_argument("-i", "--incremental", action="store_true", help="Only download posts saved since the last run (Optional).", required=False)
+    parser.add_argument("-e", "--export_text", action="store_true", help="Also export comments, links and self posts as text files (Optional).", required=False)
+    parser.add_argument("-r", "--replay", type=str, nargs="?", const="", help="Re-process the posts of the saved listing snapshots without logging in, optionally from a single snapshot file (Optional).", required=False)
+    parser.add_argument("--audit", action="store_true", help="Check the archive for missing and damaged posts, using the snapshots if no password is provided (Optional).", required=False)
+    parser.add_argument("--repair", action="store_true", help="With --audit, download again the missing and damaged posts (Optional).", required=False)
+    parser.add_argument("--prometheus", type=str, help="Path of a Prometheus textfile to write the run metrics to (Optional).", required=False)
+    parser.add_argument("--max_image_width", type=int, help="Download smaller renditions of images wider than this, in pixels (Optional).", required=False)
+    parser.add_argument("--max_image_kb", type=int, help="Download smaller renditions of images larger than this, in KB (Optional).", required=False)
+    parser.add_argument("--keep_gifs", action="store_true", help="Save GIFs as they are instead of converting them to mp4 (Optional).", required=False)
+    parser.add_argument("--max_video_height", type=int, help="Highest video resolution to download, for example 720 (Optional).", required=False)
+    parser.add_argument("--max_video_kbps", type=int, help="Highest video bitrate to download in kbit/s (Optional).", required=False)
+    parser.add_argument("--max_video_mb", type=float, help="Approximate size budget of each video with its audio in MB (Optional).", required=False)
+    parser.add_argument("--max_mb_per_sec", type=float, help="Overall download speed limit in MB/s (Optional).", required=False)
+    parser.add_argument("--time_limit", type=float, help="Stop starting new downloads after this many minutes (Optional).", required=False)
+    parser.add_argument("--overwrite_videos", action="store_true", help="Download again videos that already exist instead of skipping them (Optional).", required=False)
+    parser.add_argument("--packed", action="store_true", help="Pack the images and videos into tar shards instead of separate files (Optional).", required=False)
+    parser.add_argument("--shard_mb", type=int, help="Maximum size of each tar shard in packed mode, in MB (Optional, default 1024).", required=False)
+    parser.add_argument("--no_listing_cache", action="store_true", help="Do not cache the saved post pages between runs (Optional).", required=False)
     args = parser.parse_args()
+
+    if args.accounts:
+        run_batch(Path(args.accounts), downloader.root_path)
+        raise SystemExit
+    if not args.username or (not args.password and args.replay is None and not args.audit):
+        parser.error("the following arguments are required: -u/--username, -p/--password (or -a/--accounts)")
     
     username = args.username
     password = args.password
     from_id = args.from_id
     to_id = args.to_id
-
-    downloader.start_dl(username, password, from_id, to_id)
\ No newline at end of file
+    downloader.workers = args.workers
+    downloader.incremental = args.incremental
+    downloader.export_text = args.export_text
+    downloader.prometheus_path = args.prometheus
+    downloader.use_listing_cache = not args.no_listing_cache
+    downloader.existing_videos = "overwrite" if args.overwrite_videos else "skip"
+    downloader.max_bytes_per_sec = int(args.max_mb_per_sec * 1024 * 1024) if args.max_mb_per_sec else None
+    downloader.time_limit = args.time_limit * 60 if args.time_limit else None
+    downloader.max_image_width = args.max_image_width
+    downloader.max_image_bytes = args.max_image_kb * 1024 if args.max_image_kb else None
+    downloader.gif_policy = "gif" if args.keep_gifs else "mp4"
+    downloader.max_video_height = args.max_video_height
+    downloader.max_video_bitrate = args.max_video_kbps * 1000 if args.max_video_kbps else None
+    downloader.max_video_bytes = int(args.max_video_mb * 1024 * 1024) if args.max_video_mb else None
+    downloader.packed = args.packed
+    if args.shard_mb:
+        downloader.shard_size = args.shard_mb * 1024 * 1024
+
+    if args.audit:
+        downloader.audit(username, password, args.repair)
+    elif args.replay is not None:
+        downloader.replay(username, Path(args.replay) if args.replay else None)
+    else:
+        downloader.start_dl(username, password, from_id, to_id)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import hashlib
+import mmap
+import os
+from pathlib import Path
+
+
+def file_sha256(filepath: Path, offset: int = 0, size: int | None = None) -> str:
+    '''Returns the sha256 hash of the file, or of `size` bytes from `offset` (a file packed in a shard).
+    The file is read through a memory map, so it is hashed without being copied into memory, and as hashlib
+    releases the GIL while hashing, several files can be hashed in parallel threads.'''
+
+    with open(filepath, "rb") as file:
+        length = os.fstat(file.fileno()).st_size
+        if size is None:
+            size = length - offset
+        if size <= 0 or offset >= length:
+            return hashlib.sha256(b"").hexdigest()  # Empty files cannot be mapped.
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return hashlib.sha256(view[offset:offset + size]).hexdigest()
+            finally:
+                view.release()
+
+
+def check_file(filepath: Path, size: int, sha256: str | None, offset: int | None = None) -> str | None:
+    '''Checks the file against its indexed size and hash (only the size if the hash is unknown). With an `offset`,
+    checks the `size` bytes packed at that offset in the file instead of the whole file.
+    Returns the problem found: "missing", "size" or "hash", or None if the file is intact.'''
+
+    try:
+        length = filepath.stat().st_size
+    except OSError:
+        return "missing"
+    if (length != size) if offset is None else (length < offset + size):
+        return "size"
+    if sha256 is not None and file_sha256(filepath, offset or 0, size) != sha256:
+        return "hash"
+    return None
@@ -0,0 +1,131 @@
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+import threading
+
+
+class ArchiveIndex:
+    '''SQLite index of the posts already archived for a user, used for incremental downloads.
+    Every archived post is stored with its type and timestamp, together with the files it produced, their sizes
+    and the sha256 hash of the media files in the media store.
+    The index can be shared by the download workers, all access goes through a single lock.'''
+
+    def __init__(self, db_path: Path) -> None:
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(
+            '''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS posts (
+                id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                archived_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                post_id TEXT NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+                path TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                sha256 TEXT,
+                PRIMARY KEY (post_id, path)
+            );
+            CREATE TABLE IF NOT EXISTS sync (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            '''
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(files)")]
+        if "sha256" not in columns:  # Index created by an older version.
+            self._conn.execute("ALTER TABLE files ADD COLUMN sha256 TEXT")
+        self._conn.commit()
+        self._known = {row[0] for row in self._conn.execute("SELECT id FROM posts")}
+
+
+    def __contains__(self, post_id: str) -> bool:
+
+        return post_id in self._known
+
+
+    def __len__(self) -> int:
+
+        return len(self._known)
+
+
+    def add(self, post_id: str, post_type: str, files: list[tuple[str, int]]) -> None:
+        '''Records the post as archived, replacing any previous entry. `files` holds (relative path, bytes, sha256)
+        entries, the hash being None for files that are not in the media store.'''
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM files WHERE post_id = ?", (post_id,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO posts (id, type, archived_at) VALUES (?, ?, ?)",
+                    (post_id, post_type, datetime.now().isoformat(timespec="seconds"))
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO files (post_id, path, bytes, sha256) VALUES (?, ?, ?, ?)",
+                    [(post_id, *entry) for entry in files]
+                )
+            self._known.add(post_id)
+
+
+    def remove(self, post_id: str) -> None:
+        '''Removes the post from the index, so it will be downloaded again.'''
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM files WHERE post_id = ?", (post_id,))
+                self._conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+            self._known.discard(post_id)
+
+
+    def get(self, post_id: str) -> dict | None:
+        '''Returns the type, timestamp and files of the archived post, or None if it is not indexed.'''
+
+        with self._lock:
+            row = self._conn.execute("SELECT type, archived_at FROM posts WHERE id = ?", (post_id,)).fetchone()
+            if row is None:
+                return None
+            files = self._conn.execute("SELECT path, bytes, sha256 FROM files WHERE post_id = ?", (post_id,)).fetchall()
+        return {"id": post_id, "type": row[0], "archived_at": row[1], "files": files}
+
+
+    def files(self) -> list[tuple[str, str, str, int, str | None]]:
+        '''Returns the post ID, post type, relative path, bytes and sha256 hash of every indexed file.'''
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT files.post_id, posts.type, files.path, files.bytes, files.sha256 FROM files JOIN posts ON posts.id = files.post_id"
+            ).fetchall()
+
+
+    def file_hashes(self) -> dict[str, str]:
+        '''Returns the hash of every indexed file that is in the media store, by relative path.'''
+
+        with self._lock:
+            rows = self._conn.execute("SELECT path, sha256 FROM files WHERE sha256 IS NOT NULL").fetchall()
+        return dict(rows)
+
+
+    def get_state(self, name: str) -> str | None:
+        '''Returns the stored sync state value, or None if it was never set.'''
+
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def set_state(self, name: str, value: str) -> None:
+        '''Stores a sync state value, for example the newest post of the last complete run.'''
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO sync (name, value) VALUES (?, ?)", (name, value))
+
+
+    def close(self) -> None:
+
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,461 @@
+import argparse
+from collections import defaultdict
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+import requests
+from requests.adapters import HTTPAdapter
+
+from RedditSPD import RedditSPD
+
+try:
+    import resource
+except ImportError:  # Windows.
+    resource = None
+
+
+POST_TYPES = ("image", "gallery", "video", "gif", "self", "link", "comment")
+
+
+class SyntheticArchive:
+    '''Synthetic saved post history with the media served by the stand-in server.'''
+
+    def __init__(self, posts: int, mix: dict[str, float], image_kb: int, video_kb: int, audio_kb: int, seed: int = 0) -> None:
+
+        rng = random.Random(seed)
+        self.image = self._make_image(image_kb, rng)
+        self.preview = self._make_image(max(1, image_kb // 8), rng)
+        self.video, self.audio = self._make_video(video_kb, audio_kb, rng)
+        self.gif, self.gif_mp4 = self._make_gif(rng)
+        self.posts = []
+        types = list(mix.keys())
+        weights = list(mix.values())
+        for i in range(posts):
+            self.posts.append(self._make_post(f'b{i:06d}', rng.choices(types, weights)[0]))
+        self.ids = [post["data"]["id"] for post in self.posts]
+        self.positions = {post_id: position for position, post_id in enumerate(self.ids)}
+
+
+    def _make_image(self, image_kb: int, rng: random.Random) -> bytes:
+        '''Returns a valid JPEG padded with a comment segment up to about the requested size.'''
+
+        output = BytesIO()
+        Image.new("RGB", (64, 64), (rng.randrange(256), 80, 160)).save(output, format="JPEG")
+        data = output.getvalue()
+        padding = max(0, image_kb * 1024 - len(data))
+        segments = b""
+        while padding > 0:
+            size = min(padding, 65000)
+            segments += b"\xff\xfe" + (size + 2).to_bytes(2, "big") + rng.randbytes(size)
+            padding -= size + 4
+        return data[:2] + segments + data[2:]
+
+
+    def _make_video(self, video_kb: int, audio_kb: int, rng: random.Random) -> tuple[bytes, bytes]:
+        '''Returns real mp4 streams when FFMPEG is available, so the mux step is measured too, random bytes otherwise.'''
+
+        with tempfile.TemporaryDirectory() as temp:
+            video_path = Path(temp) / "video.mp4"
+            audio_path = Path(temp) / "audio.mp4"
+            seconds = 5
+            try:
+                subprocess.run(
+                    ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=25:duration={seconds}",
+                     "-c:v", "mpeg4", "-b:v", f"{video_kb * 8 // seconds}k", str(video_path)],
+                    check=True
+                )
+                subprocess.run(
+                    ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi", "-i", f"sine=duration={seconds}",
+                     "-c:a", "aac", "-b:a", f"{max(8, audio_kb * 8 // seconds)}k", str(audio_path)],
+                    check=True
+                )
+                return video_path.read_bytes(), audio_path.read_bytes()
+            except (OSError, subprocess.CalledProcessError):
+                return rng.randbytes(video_kb * 1024), rng.randbytes(audio_kb * 1024)
+
+
+    def _make_gif(self, rng: random.Random) -> tuple[bytes, bytes]:
+        '''Returns an animated GIF and its mp4 variant, made with FFMPEG when it is available.'''
+
+        frames = [Image.effect_noise((160, 120), 40 + 10 * n).convert("P") for n in range(10)]
+        output = BytesIO()
+        frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+        gif = output.getvalue()
+        with tempfile.TemporaryDirectory() as temp:
+            gif_path = Path(temp) / "animation.gif"
+            mp4_path = Path(temp) / "animation.mp4"
+            gif_path.write_bytes(gif)
+            try:
+                subprocess.run(
+                    ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", str(gif_path), "-pix_fmt", "yuv420p", str(mp4_path)],
+                    check=True
+                )
+                return gif, mp4_path.read_bytes()
+            except (OSError, subprocess.CalledProcessError):
+                return gif, rng.randbytes(len(gif) // 4)
+
+
+    def _make_post(self, post_id: str, post_type: str) -> dict:
+
+        data = {"id": post_id, "title": f'Benchmark post {post_id}', "author": "benchmark", "permalink": f'/r/benchmark/comments/{post_id}/post/'}
+        if post_type == "image":
+            data.update(domain="i.redd.it", url=f'https://i.redd.it/{post_id}.jpg', preview={"images": [{
+                "source": {"url": f'https://preview.redd.it/{post_id}.jpg?auto=webp&amp;s=0', "width": 1920, "height": 1080},
+                "resolutions": [{"url": f'https://preview.redd.it/{post_id}.jpg?width=640&amp;s=0', "width": 640, "height": 360}]
+            }]})
+        elif post_type == "gif":
+            data.update(domain="i.redd.it", url=f'https://i.redd.it/{post_id}.gif')
+            if int(post_id[1:]) % 2 == 0:
+                # Half of the GIFs have an mp4 variant, the others are transcoded.
+                data["preview"] = {"images": [{
+                    "source": {"url": f'https://preview.redd.it/{post_id}.gif?s=0', "width": 160, "height": 120},
+                    "variants": {"mp4": {"source": {"url": f'https://preview.redd.it/{post_id}.gif?format=mp4&amp;s=0', "width": 160, "height": 120}}}
+                }]}
+        elif post_type == "gallery":
+            data.update(is_gallery=True, media_metadata={f'{post_id}g{n}': {
+                "m": "image/jpg",
+                "s": {"x": 1920, "y": 1080, "u": f'https://preview.redd.it/{post_id}g{n}.jpg?auto=webp&amp;s=0'},
+                "p": [{"x": 640, "y": 360, "u": f'https://preview.redd.it/{post_id}g{n}.jpg?width=640&amp;s=0'}]
+            } for n in range(3)})
+        elif post_type == "video":
+            data.update(is_video=True, secure_media={"reddit_video": {
+                "fallback_url": f'https://v.redd.it/{post_id}/DASH_720.mp4?source=fallback',
+                "dash_url": f'https://v.redd.it/{post_id}/DASHPlaylist.mpd',
+                "has_audio": True
+            }})
+        elif post_type == "self":
+            data.update(is_self=True, url=f'https://www.reddit.com{data["permalink"]}', selftext="Lorem ipsum " * 50)
+        elif post_type == "link":
+            data.update(domain="example.com", url=f'https://example.com/{post_id}')
+        else:
+            return {"kind": "t1", "data": {
+                "id": post_id, "link_title": f'Benchmark comment {post_id}', "author": "benchmark", "body": "Lorem ipsum " * 20,
+                "link_permalink": f'https://www.reddit.com/r/benchmark/comments/{post_id}/', "permalink": data["permalink"]
+            }}
+        return {"kind": "t3", "data": data}
+
+
+    def mpd(self, post_id: str, older: bool = False) -> str:
+        '''Returns a DASH playlist listing the video and audio streams of the post. Older posts list the `audio` stream.'''
+
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" mediaPresentationDuration="PT5S" type="static">\n'
+            '  <Period duration="PT5S">\n'
+            '    <AdaptationSet contentType="video" mimeType="video/mp4">\n'
+            f'      <Representation id="720" bandwidth="{len(self.video) * 8 // 5}" width="640" height="360"><BaseURL>DASH_720.mp4</BaseURL></Representation>\n'
+            '    </AdaptationSet>\n'
+            '    <AdaptationSet contentType="audio" mimeType="audio/mp4">\n'
+            f'      <Representation id="AUDIO_128" bandwidth="{len(self.audio) * 8 // 5}"><BaseURL>{"audio" if older else "DASH_AUDIO_128.mp4"}</BaseURL></Representation>\n'
+            '    </AdaptationSet>\n'
+            '  </Period>\n'
+            '</MPD>\n'
+        )
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Request handler of the stand-in server. The Reddit host is taken from the `Host` header.'''
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+
+        pass
+
+
+    def _send(self, code: int, body: bytes = b"", content_type: str = "application/octet-stream", headers: dict | None = None) -> None:
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # Client closed a size probe early.
+            return
+        self.server.stats.add(self.headers.get("Host", ""), code, len(body))
+
+
+    def _inject(self) -> bool:
+        '''Randomly answers with 429 to exercise the retry and rate limit handling.'''
+
+        if self.server.rng.random() < self.server.rate_429:
+            self._send(429, headers={"Retry-After": "0"})
+            return True
+        return False
+
+
+    def do_POST(self) -> None:
+
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._send(200, b'{"json": {"errors": []}}', "application/json")
+
+
+    def do_GET(self) -> None:
+
+        host = self.headers.get("Host", "")
+        url = urlparse(self.path)
+        archive = self.server.archive
+        if self._inject():
+            return
+
+        if host == "old.reddit.com" and url.path.endswith("/saved.json"):
+            after = parse_qs(url.query).get("after", [None])[0]
+            start = 0 if after is None else archive.positions[after] + 1
+            page = archive.posts[start:start + self.server.page_size]
+            next_after = page[-1]["data"]["id"] if start + len(page) < len(archive.posts) else None
+            body = json.dumps({"kind": "Listing", "data": {"children": page, "dist": len(page), "after": next_after}}).encode()
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, headers={"ETag": etag})
+            return self._send(200, body, "application/json", {"ETag": etag})
+
+        if host == "i.redd.it":
+            if url.path.endswith(".gif"):
+                return self._send(200, archive.gif, "image/gif")
+            return self._send(200, archive.image, "image/jpeg")
+
+        if host == "preview.redd.it":
+            query = parse_qs(url.query)
+            if query.get("format") == ["mp4"]:
+                return self._send(200, archive.gif_mp4, "video/mp4")
+            return self._send(200, archive.preview if "width" in query else archive.image, "image/jpeg")
+
+        if host == "v.redd.it":
+            post_id = url.path.split("/")[1]
+            # Older posts only have the "audio" stream.
+            older = random.Random(post_id).random() < self.server.rate_403
+            if url.path.endswith(".mpd"):
+                return self._send(200, archive.mpd(post_id, older).encode(), "application/dash+xml")
+            if "AUDIO" in url.path or url.path.endswith("/audio"):
+                if older != url.path.endswith("/audio"):
+                    return self._send(403)
+                data = archive.audio
+            else:
+                data = archive.video
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match is None:
+                return self._send(200, data, "video/mp4")
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            return self._send(206, data[start:end + 1], "video/mp4", {"Content-Range": f'bytes {start}-{end}/{len(data)}'})
+
+        self._send(404)
+
+
+class ServerStats:
+    '''Thread-safe counters of the responses sent by the stand-in server.'''
+
+    def __init__(self) -> None:
+
+        self.bytes = 0
+        self.codes = defaultdict(int)
+        self._lock = threading.Lock()
+
+
+    def add(self, host: str, code: int, size: int) -> None:
+
+        with self._lock:
+            self.bytes += size
+            self.codes[f'{host} {code}'] += 1
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''Threaded stand-in server that ignores clients dropping their connections.'''
+
+    def handle_error(self, request, client_address) -> None:
+
+        # Keep-alive connections are dropped by the client when its session closes, that is not an error.
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_server(archive: SyntheticArchive, page_size: int, rate_429: float, rate_403: float, seed: int) -> StandInServer:
+    '''Starts the stand-in server on a free local port in a background thread.'''
+
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.archive = archive
+    server.page_size = page_size
+    server.rate_429 = rate_429
+    server.rate_403 = rate_403
+    server.rng = random.Random(seed)
+    server.stats = ServerStats()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StandInAdapter(HTTPAdapter):
+    '''Transport adapter sending the requests for the Reddit hosts to the stand-in server, keeping the original host.'''
+
+    def __init__(self, port: int, **kwargs) -> None:
+
+        self.port = port
+        super().__init__(**kwargs)
+
+
+    def send(self, request, **kwargs):
+
+        url = urlparse(request.url)
+        request.headers["Host"] = url.hostname
+        request.url = url._replace(scheme="http", netloc=f'127.0.0.1:{self.port}').geturl()
+        return super().send(request, **kwargs)
+
+
+class BenchmarkSPD(RedditSPD):
+    '''RedditSPD talking to the stand-in server and timing each post by type.'''
+
+    def __init__(self, port: int) -> None:
+
+        self.port = port
+        self.latencies = defaultdict(list)
+        self._latency_lock = threading.Lock()
+        super().__init__()
+
+
+    def _new_session(self) -> requests.Session:
+
+        session = super()._new_session()
+        pool_size = max([self.default_host_limit, *self.host_limits.values()])
+        adapter = StandInAdapter(self.port, pool_connections=len(self.host_limits) + 1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    def _get_content(self, post: dict):
+
+        start = time.perf_counter()
+        result = super()._get_content(post)
+        with self._latency_lock:
+            self.latencies[result[0]].append(time.perf_counter() - start)
+        return result
+
+
+def peak_rss_mb() -> float | None:
+    '''Returns the peak resident memory of the benchmark and its child processes in MB, if available.'''
+
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB on Linux.
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(usage, children) / scale
+
+
+def percentile(values: list[float], fraction: float) -> float:
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    '''Runs `RedditSPD.start_dl` against a synthetic archive and returns the measurements.'''
+
+    mix = {}
+    for item in args.mix.split(","):
+        post_type, weight = item.split("=")
+        if post_type not in POST_TYPES:
+            raise ValueError(f'Unknown post type "{post_type}".')
+        mix[post_type] = float(weight)
+
+    archive = SyntheticArchive(args.posts, mix, args.image_kb, args.video_kb, args.audio_kb, args.seed)
+    server = start_server(archive, args.page_size, args.rate_429, args.rate_403, args.seed)
+    work_dir = Path(tempfile.mkdtemp(prefix="rspd-bench-"))
+    cwd = Path.cwd()
+    try:
+        os.chdir(work_dir)  # error.log is written to the working directory.
+        downloader = BenchmarkSPD(server.server_address[1])
+        downloader.root_path = work_dir
+        downloader.workers = args.workers
+        downloader.max_image_width = args.max_image_width
+        if args.no_rate_limit:
+            downloader.host_rates = {host: (10000.0, 10000) for host in downloader.host_rates}
+            downloader.default_host_rate = (10000.0, 10000)
+
+        start = time.perf_counter()
+        downloader.start_dl("benchmark", "benchmark")
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for _ in open(work_dir / "error.log")) if (work_dir / "error.log").exists() else 0
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Only the posts that were actually archived count towards the throughput.
+    archived = downloader.metrics.posts.get("archived", 0)
+    return {
+        "posts": args.posts,
+        "archived": archived,
+        "failed": downloader.metrics.posts.get("failed", 0),
+        "workers": args.workers,
+        "seconds": round(elapsed, 3),
+        "posts_per_sec": round(archived / elapsed, 2),
+        "mb_per_sec": round(server.stats.bytes / elapsed / 1024 / 1024, 2),
+        "bytes": server.stats.bytes,
+        "errors": errors,
+        "peak_rss_mb": None if peak_rss_mb() is None else round(peak_rss_mb(), 1),
+        "latency": {
+            post_type: {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values) * 1000, 1),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1)
+            }
+            for post_type, values in downloader.latencies.items()
+        },
+        "responses": dict(server.stats.codes),
+        "archive": str(work_dir) if args.keep else None
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of RedditSPD against a local Reddit stand-in server.")
+    parser.add_argument("-n", "--posts", type=int, default=200, help="Number of saved posts in the synthetic archive (default 200).")
+    parser.add_argument("-m", "--mix", type=str, default="image=35,gallery=10,video=10,self=15,link=15,comment=15", help="Weights of the post types.")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of download workers (default 8).")
+    parser.add_argument("--page_size", type=int, default=25, help="Posts per saved.json page (default 25).")
+    parser.add_argument("--image_kb", type=int, default=200, help="Size of each image in KB (default 200).")
+    parser.add_argument("--video_kb", type=int, default=4096, help="Size of each video stream in KB (default 4096).")
+    parser.add_argument("--audio_kb", type=int, default=256, help="Size of each audio stream in KB (default 256).")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="Fraction of requests answered with 429 (default 0).")
+    parser.add_argument("--rate_403", type=float, default=0.0, help="Fraction of videos that only have the older 'audio' stream (default 0).")
+    parser.add_argument("--max_image_width", type=int, help="Download the smaller image renditions up to this width.")
+    parser.add_argument("--no_rate_limit", action="store_true", help="Disable the per-host rate limits to measure raw throughput.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic archive.")
+    parser.add_argument("--keep", action="store_true", help="Keep the downloaded archive instead of deleting it.")
+    parser.add_argument("--json", type=str, help="Also write the results to this json file.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+
+    print()
+    print(f'{results["archived"]} of {results["posts"]} posts archived in {results["seconds"]}s with {results["workers"]} workers: '
+          f'{results["posts_per_sec"]} posts/s, {results["mb_per_sec"]} MB/s, {results["errors"]} errors, '
+          f'peak RSS {results["peak_rss_mb"]} MB.')
+    for post_type, latency in sorted(results["latency"].items()):
+        print(f'  {post_type:<8} n={latency["count"]:<5} mean={latency["mean_ms"]}ms p50={latency["p50_ms"]}ms p95={latency["p95_ms"]}ms')
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
@@ -0,0 +1,113 @@
+import re
+from urllib.parse import urljoin
+import xml.etree.ElementTree as ET
+
+
+def parse_duration(value: str | None) -> float | None:
+    '''Returns the seconds of an ISO 8601 duration as used by DASH playlists, for example `PT1M4.5S`.'''
+
+    if not value:
+        return None
+    match = re.fullmatch(r"P(?:(\d+(?:\.\d+)?)D)?(?:T(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?(?:(\d+(?:\.\d+)?)S)?)?", value.strip())
+    if match is None:
+        return None
+    days, hours, minutes, seconds = (float(group) if group else 0.0 for group in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def _local_name(tag: str) -> str:
+
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(element: ET.Element, name: str) -> list[ET.Element]:
+    '''Returns the direct children with the tag name, whatever the namespace of the playlist.'''
+
+    return [child for child in element if _local_name(child.tag) == name]
+
+
+def _base_url(element: ET.Element, base: str) -> str:
+
+    for child in _children(element, "BaseURL"):
+        if child.text and child.text.strip():
+            return urljoin(base, child.text.strip())
+    return base
+
+
+def parse_mpd(text: str | bytes, mpd_url: str) -> tuple[float | None, list[dict]]:
+    '''Parses a DASH playlist (`DASHPlaylist.mpd`) and returns its duration in seconds and its representations.
+    Each representation is a dictionary with its `id`, `kind` ("video" or "audio"), `bandwidth` in bits per second,
+    `width`, `height` and absolute `url`. Raises ValueError if the playlist cannot be read.'''
+
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError as e:
+        raise ValueError(f"Invalid DASH playlist: {e}")
+    if _local_name(root.tag) != "MPD":
+        raise ValueError("Invalid DASH playlist: no MPD element.")
+
+    duration = parse_duration(root.get("mediaPresentationDuration"))
+    base = _base_url(root, mpd_url)
+    representations = []
+    for period in _children(root, "Period"):
+        if duration is None:
+            duration = parse_duration(period.get("duration"))
+        period_base = _base_url(period, base)
+        for adaptation in _children(period, "AdaptationSet"):
+            adaptation_base = _base_url(adaptation, period_base)
+            adaptation_kind = adaptation.get("contentType") or (adaptation.get("mimeType") or "").split("/")[0]
+            for representation in _children(adaptation, "Representation"):
+                kind = adaptation_kind or (representation.get("mimeType") or "").split("/")[0]
+                if not kind:
+                    # Older playlists do not always say it, only video streams have a size.
+                    kind = "video" if representation.get("height") else "audio"
+                if kind not in ("video", "audio"):
+                    continue
+                representations.append({
+                    "id": representation.get("id"),
+                    "kind": kind,
+                    "bandwidth": int(representation.get("bandwidth") or 0),
+                    "width": int(representation.get("width") or 0),
+                    "height": int(representation.get("height") or 0),
+                    "url": _base_url(representation, adaptation_base)
+                })
+
+    if not any(item["kind"] == "video" for item in representations):
+        raise ValueError("Invalid DASH playlist: no video representation.")
+    return duration, representations
+
+
+def estimated_bytes(representation: dict | None, duration: float | None) -> int:
+    '''Returns the approximate size of the representation, from its bandwidth and the duration of the playlist.'''
+
+    if representation is None or not duration:
+        return 0
+    return int(representation["bandwidth"] * duration / 8)
+
+
+def select_representations(representations: list[dict], duration: float | None, max_height: int | None = None,
+                           max_bitrate: int | None = None, max_bytes: int | None = None) -> tuple[dict, dict | None]:
+    '''Returns the video and audio representations to download: the best video within the maximum height,
+    bitrate (bits per second) and estimated size of video plus audio, and the best audio. Limits that cannot
+    be met fall back to the smallest video. The audio is None if the playlist has no audio stream.'''
+
+    videos = sorted((item for item in representations if item["kind"] == "video"), key=lambda item: (item["bandwidth"], item["height"]))
+    audios = sorted((item for item in representations if item["kind"] == "audio"), key=lambda item: item["bandwidth"])
+
+    audio = audios[-1] if audios else None
+    if max_bytes is not None and duration and audio is not None:
+        # Keep the best audio that still leaves room for the smallest video.
+        fitting = [item for item in audios if estimated_bytes(item, duration) + estimated_bytes(videos[0], duration) <= max_bytes]
+        audio = fitting[-1] if fitting else audios[0]
+
+    allowed = []
+    for item in videos:
+        if max_height is not None and item["height"] > max_height:
+            continue
+        if max_bitrate is not None and item["bandwidth"] > max_bitrate:
+            continue
+        if max_bytes is not None and duration and estimated_bytes(item, duration) + estimated_bytes(audio, duration) > max_bytes:
+            continue
+        allowed.append(item)
+    video = allowed[-1] if allowed else videos[0]
+    return video, audio
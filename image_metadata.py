@@ -0,0 +1,69 @@
+from io import BytesIO
+import struct
+
+from PIL import Image
+
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+EXIF_HEADER = b"Exif\x00\x00"
+
+
+def is_jpeg(data: bytes) -> bool:
+    '''Returns whether the bytes are a JPEG file, regardless of the extension in the url.'''
+
+    return data[:3] == JPEG_MAGIC
+
+
+def build_exif(im: Image.Image, title: str, comment: str) -> bytes:
+    '''Returns the EXIF block of the image with the title (270) and XP comment (40092) tags set.'''
+
+    exif = im.getexif()
+    exif[270] = title
+    exif[40092] = comment.encode("utf-16")
+    return exif.tobytes()
+
+
+def inject_exif(data: bytes, title: str, comment: str) -> bytes:
+    '''Returns the JPEG bytes with the metadata written in a new EXIF (APP1) segment, without decoding the pixels.
+    Any existing EXIF segment is replaced, the tags it contains are kept. Raises ValueError if the JPEG can't be parsed.'''
+
+    # Opening only parses the headers, the pixel data is never decoded.
+    exif = build_exif(Image.open(BytesIO(data)), title, comment)
+    if not exif.startswith(EXIF_HEADER):
+        exif = EXIF_HEADER + exif
+    if len(exif) + 2 > 0xFFFF:
+        raise ValueError("EXIF segment too large.")
+    app1 = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+
+    # Walk the segments before the image data, dropping old EXIF segments.
+    segments = []
+    insert_at = 0
+    position = 2
+    while True:
+        if position + 4 > len(data) or data[position] != 0xFF:
+            raise ValueError("Invalid JPEG segment.")
+        marker = data[position + 1]
+        if marker == 0xDA:  # Start of scan, the rest is image data.
+            break
+        length = struct.unpack(">H", data[position + 2:position + 4])[0]
+        segment = data[position:position + 2 + length]
+        if marker == 0xE1 and segment[4:10] == EXIF_HEADER:
+            pass
+        else:
+            segments.append(segment)
+            if marker == 0xE0:  # JFIF header must stay first.
+                insert_at = len(segments)
+        position += 2 + length
+
+    segments.insert(insert_at, app1)
+    return data[:2] + b"".join(segments) + data[position:]
+
+
+def convert_to_jpeg(data: bytes, title: str, comment: str) -> bytes:
+    '''Decodes the image, converts it to RGB and returns it encoded as JPEG with the metadata.
+    Kept at module level so it can run in a process pool.'''
+
+    im = Image.open(BytesIO(data)).convert("RGB")
+    output = BytesIO()
+    im.save(output, format="JPEG", exif=build_exif(im, title, comment))
+    return output.getvalue()
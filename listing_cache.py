@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+
+class ListingCache:
+    '''On-disk HTTP cache of the saved.json listing pages, keyed by account and url.
+    The size accounting is kept in memory, so a cache directory must only be used by one process at a time.
+    Each entry keeps the `ETag`/`Last-Modified` validators of the response next to its gzip compressed body,
+    so the page can be revalidated with a conditional request. The least recently used entries are evicted
+    once the total size of the cache goes over `max_bytes`.'''
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 64 * 1024 * 1024) -> None:
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total = sum(path.stat().st_size for path in self.cache_dir.iterdir() if path.suffix in (".json", ".gz"))
+
+
+    def _key(self, account: str, url: str) -> str:
+
+        return hashlib.sha256(f'{account}\n{url}'.encode("utf-8")).hexdigest()
+
+
+    def _paths(self, account: str, url: str) -> tuple[Path, Path]:
+
+        key = self._key(account, url)
+        return self.cache_dir / f'{key}.json', self.cache_dir / f'{key}.gz'
+
+
+    def conditional_headers(self, account: str, url: str) -> dict[str, str]:
+        '''Returns the `If-None-Match`/`If-Modified-Since` headers for the cached page, if there is one.'''
+
+        meta_path, body_path = self._paths(account, url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if not body_path.exists():
+            return {}
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+
+    def load(self, account: str, url: str) -> bytes | None:
+        '''Returns the cached body of the page and marks the entry as recently used.'''
+
+        meta_path, body_path = self._paths(account, url)
+        try:
+            with gzip.open(body_path, "rb") as file:
+                body = file.read()
+            now = time.time()
+            os.utime(meta_path, (now, now))
+        except OSError:  # Entry evicted in the meantime.
+            return None
+        return body
+
+
+    def store(self, account: str, url: str, headers, body: bytes) -> None:
+        '''Caches the body of the page if the response has validators, then evicts old entries if needed.'''
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+
+        meta_path, body_path = self._paths(account, url)
+        with self._lock:
+            self._total -= sum(path.stat().st_size for path in (meta_path, body_path) if path.exists())
+            temp_path = body_path.with_name(body_path.name + ".tmp")
+            with gzip.open(temp_path, "wb") as file:
+                file.write(body)
+            os.replace(temp_path, body_path)
+            with open(meta_path, "w", encoding="utf-8") as file:
+                json.dump({"url": url, "etag": etag, "last_modified": last_modified, "stored_at": time.time()}, file)
+            self._total += meta_path.stat().st_size + body_path.stat().st_size
+            if self._total > self.max_bytes:
+                self._evict()
+
+
+    def _evict(self) -> None:
+        '''Removes the least recently used entries until the cache fits in `max_bytes`. Must hold the lock.'''
+
+        entries = []
+        total = 0
+        for meta_path in self.cache_dir.glob("*.json"):
+            body_path = meta_path.with_suffix(".gz")
+            try:
+                size = meta_path.stat().st_size + body_path.stat().st_size
+                used = meta_path.stat().st_mtime
+            except OSError:
+                continue
+            entries.append((used, size, meta_path, body_path))
+            total += size
+
+        for used, size, meta_path, body_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        self._total = total
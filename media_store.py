@@ -0,0 +1,125 @@
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import threading
+import uuid
+
+
+class MediaStore:
+    '''Content-addressed store of the downloaded media. Each distinct file is kept once, named by its sha256 hash,
+    under `root/<first 2 hex digits>/<hash><suffix>`, and the files in the archive folders are hardlinks to it
+    (copies if the filesystem does not support hardlinks). The hashes of the blobs and of the linked names are
+    kept in memory, so storing a file that is already there costs no extra disk access.'''
+
+    def __init__(self, root: Path, names: dict[Path, str] | None = None) -> None:
+
+        self.root = root
+        self.temp_dir = root / "tmp"
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.names = dict(names or {})
+        self._blobs = set()
+        self._lock = threading.Lock()
+
+
+    def blob_path(self, digest: str, suffix: str) -> Path:
+
+        return self.root / digest[:2] / f'{digest}{suffix}'
+
+
+    def temp_path(self, suffix: str) -> Path:
+        '''Returns a unique path in the store to write a file to before adding it with `put_file`.'''
+
+        return self.temp_dir / f'{uuid.uuid4().hex}{suffix}'
+
+
+    def _has_blob(self, blob: Path) -> bool:
+
+        with self._lock:
+            if blob in self._blobs:
+                return True
+        if blob.exists():
+            with self._lock:
+                self._blobs.add(blob)
+            return True
+        return False
+
+
+    def _add_blob(self, source: Path, blob: Path) -> None:
+        '''Moves the finished temporary file to its blob path, unless an identical blob was added in the meantime.'''
+
+        if self._has_blob(blob):
+            os.remove(source)
+            return
+        blob.parent.mkdir(exist_ok=True)
+        os.replace(source, blob)
+        with self._lock:
+            self._blobs.add(blob)
+
+
+    def put(self, data: bytes, suffix: str) -> tuple[str, Path]:
+        '''Stores the content if it is not stored yet. Returns its hash and blob path.'''
+
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self.blob_path(digest, suffix)
+        if not self._has_blob(blob):
+            temp_path = self.temp_path(suffix)
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            self._add_blob(temp_path, blob)
+        return digest, blob
+
+
+    def put_file(self, filepath: Path, suffix: str | None = None) -> tuple[str, Path]:
+        '''Moves the file into the store (or deletes it if the content is already stored), hashing it in chunks.
+        The file must be on the same filesystem as the store, see `temp_path`. Returns its hash and blob path.'''
+
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            for chunk in iter(lambda: file.read(1048576), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        blob = self.blob_path(digest, filepath.suffix if suffix is None else suffix)
+        self._add_blob(filepath, blob)
+        return digest, blob
+
+
+    def link(self, digest: str, blob: Path, target: Path) -> None:
+        '''Makes `target` a hardlink to the blob, replacing any other file with that name.
+        The existing file is never written to, as it may be a link to another blob.'''
+
+        with self._lock:
+            known = self.names.get(target) == digest
+        try:
+            os.link(blob, target)
+        except FileExistsError:
+            if known or os.path.samefile(blob, target):
+                # Already linked. Replacing a link with another link to the same file would do nothing.
+                with self._lock:
+                    self.names[target] = digest
+                return
+            temp_path = target.with_name(f'_link-{uuid.uuid4().hex}{target.suffix}')
+            self._link_or_copy(blob, temp_path)
+            os.replace(temp_path, target)
+        except OSError:
+            # No hardlinks on this filesystem, or the store is on another device.
+            temp_path = target.with_name(f'_link-{uuid.uuid4().hex}{target.suffix}')
+            shutil.copyfile(blob, temp_path)
+            os.replace(temp_path, target)
+        with self._lock:
+            self.names[target] = digest
+
+
+    def _link_or_copy(self, blob: Path, target: Path) -> None:
+
+        try:
+            os.link(blob, target)
+        except OSError:
+            shutil.copyfile(blob, target)
+
+
+    def digest(self, target: Path) -> str | None:
+        '''Returns the hash of the content linked at the path, if it was linked by the store.'''
+
+        with self._lock:
+            return self.names.get(target)
@@ -0,0 +1,169 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+
+class Metrics:
+    '''Thread-safe run instrumentation: time spent per stage (overall and per post), status codes, retries
+    and bytes transferred per host. The post a stage belongs to is taken from the current thread,
+    see `bind`, so helpers running on other threads have to bind the post themselves.'''
+
+    stages = ("listing", "request_wait", "transfer", "image_processing", "ffmpeg_mux", "disk_write")
+
+    def __init__(self) -> None:
+
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.stage_seconds = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        self.post_stages = defaultdict(lambda: defaultdict(float))
+        self.post_types = {}
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+        self.retries = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.posts = defaultdict(int)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+    @property
+    def current_post(self) -> str | None:
+
+        return getattr(self._local, "post_id", None)
+
+
+    @contextmanager
+    def bind(self, post_id: str | None):
+        '''Attributes the stages timed by the current thread to the post while the context is active.'''
+
+        previous = self.current_post
+        self._local.post_id = post_id
+        try:
+            yield
+        finally:
+            self._local.post_id = previous
+
+
+    @contextmanager
+    def stage(self, name: str):
+        '''Times the block as the named stage.'''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+
+    def add_time(self, name: str, seconds: float) -> None:
+
+        post_id = self.current_post
+        with self._lock:
+            self.stage_seconds[name] += seconds
+            self.stage_counts[name] += 1
+            if post_id is not None:
+                self.post_stages[post_id][name] += seconds
+
+
+    def add_response(self, host: str, status_code: int, retry: bool) -> None:
+
+        with self._lock:
+            self.status_codes[host][status_code] += 1
+            if retry:
+                self.retries[host] += 1
+
+
+    def add_bytes(self, host: str, size: int) -> None:
+
+        with self._lock:
+            self.bytes[host] += size
+
+
+    def add_post(self, post_id: str | None, post_type: str, archived: bool) -> None:
+
+        with self._lock:
+            self.posts["archived" if archived else "failed"] += 1
+            if post_id is not None:
+                self.post_types[post_id] = post_type
+
+
+    def add_skipped(self, post_id: str | None) -> None:
+        '''Counts a post left for a later run, for example when the time limit is reached.'''
+
+        with self._lock:
+            self.posts["skipped"] += 1
+
+
+    def summary(self) -> dict:
+        '''Returns the run summary as a json-serializable dictionary.'''
+
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            total_bytes = sum(self.bytes.values())
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "seconds": round(elapsed, 3),
+                "posts": dict(self.posts),
+                "bytes": dict(self.bytes),
+                "mb_per_sec": round(total_bytes / elapsed / 1024 / 1024, 3) if elapsed else 0,
+                "stages": {
+                    name: {"seconds": round(self.stage_seconds[name], 3), "count": self.stage_counts[name]}
+                    for name in self.stage_seconds
+                },
+                "status_codes": {host: dict(codes) for host, codes in self.status_codes.items()},
+                "retries": dict(self.retries),
+                "per_post": {
+                    post_id: {"type": self.post_types.get(post_id), **{name: round(seconds, 4) for name, seconds in stages.items()}}
+                    for post_id, stages in self.post_stages.items()
+                }
+            }
+
+
+    def write_summary(self, filepath: Path) -> None:
+        '''Writes the json run summary.'''
+
+        with open(filepath, "w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=4)
+
+
+    def write_prometheus(self, filepath: Path, labels: dict[str, str] | None = None) -> None:
+        '''Writes the totals in the Prometheus text format, for the node exporter textfile collector.
+        The file is replaced atomically so the collector never reads a partial file.'''
+
+        summary = self.summary()
+        base = ",".join(f'{key}="{value}"' for key, value in (labels or {}).items())
+
+        def label_set(**extra) -> str:
+            items = [base] if base else []
+            items += [f'{key}="{value}"' for key, value in extra.items()]
+            return "{" + ",".join(items) + "}" if items else ""
+
+        lines = [
+            "# HELP redditspd_run_seconds Duration of the last run.",
+            "# TYPE redditspd_run_seconds gauge",
+            f'redditspd_run_seconds{label_set()} {summary["seconds"]}',
+            "# HELP redditspd_posts Posts handled in the last run.",
+            "# TYPE redditspd_posts gauge"
+        ]
+        lines += [f'redditspd_posts{label_set(result=result)} {count}' for result, count in summary["posts"].items()]
+        lines += ["# HELP redditspd_stage_seconds Time spent per stage in the last run.", "# TYPE redditspd_stage_seconds gauge"]
+        lines += [f'redditspd_stage_seconds{label_set(stage=name)} {stage["seconds"]}' for name, stage in summary["stages"].items()]
+        lines += ["# HELP redditspd_bytes Bytes transferred per host in the last run.", "# TYPE redditspd_bytes gauge"]
+        lines += [f'redditspd_bytes{label_set(host=host)} {size}' for host, size in summary["bytes"].items()]
+        lines += ["# HELP redditspd_responses Responses per host and status code in the last run.", "# TYPE redditspd_responses gauge"]
+        lines += [
+            f'redditspd_responses{label_set(host=host, code=code)} {count}'
+            for host, codes in summary["status_codes"].items() for code, count in codes.items()
+        ]
+        lines += ["# HELP redditspd_retries Retried requests per host in the last run.", "# TYPE redditspd_retries gauge"]
+        lines += [f'redditspd_retries{label_set(host=host)} {count}' for host, count in summary["retries"].items()]
+
+        temp_path = filepath.with_name(filepath.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, filepath)
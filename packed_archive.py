@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import json
+from pathlib import Path
+import tarfile
+import threading
+import time
+
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def _padded(size: int) -> int:
+
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+class PackedArchive:
+    '''Packs the archived files into uncompressed, size-capped tar shards (`shard-00000.tar`, ...) instead of one file
+    per item. Every shard has a sidecar index (`shard-00000.idx`, one json line per file with the post ID, name, data
+    offset, size and sha256), so any file can be read straight from its offset. The shards are regular tar files
+    that can also be extracted with any tar tool. After an interruption, writing resumes right after the last
+    indexed file, so a partially written file is dropped.'''
+
+    def __init__(self, shard_dir: Path, max_bytes: int = 1024 * 1024 * 1024) -> None:
+
+        self.shard_dir = shard_dir
+        self.max_bytes = max_bytes
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.entries = {}
+        self._shard_number = 0
+        self._position = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+        for idx_path in sorted(self.shard_dir.glob("shard-*.idx")):
+            number = int(idx_path.stem.split("-")[1])
+            with open(idx_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # Line cut short by an interruption.
+                        continue
+                    entry["shard"] = f'shard-{number:05d}.tar'
+                    self.entries[entry["name"]] = entry
+                    # Files are indexed in the order they are written, so the last line of the last shard ends it.
+                    self._shard_number = number
+                    self._position = _padded(entry["offset"] + entry["size"])
+
+
+    def _shard_path(self, number: int) -> Path:
+
+        return self.shard_dir / f'shard-{number:05d}.tar'
+
+
+    def _open(self) -> None:
+        '''Opens the current shard for writing at the end of its last indexed file.'''
+
+        shard_path = self._shard_path(self._shard_number)
+        self._file = open(shard_path, "r+b" if shard_path.exists() else "wb")
+        self._file.truncate(self._position)
+        self._file.seek(self._position)
+
+
+    def _close_shard(self) -> None:
+        '''Ends the current shard with the end-of-archive blocks, which are overwritten if more files are added later.'''
+
+        if self._file is None:
+            return
+        self._file.write(b"\0" * BLOCK_SIZE * 2)
+        self._file.close()
+        self._file = None
+
+
+    def add(self, post_id: str, name: str, source: bytes | Path) -> tuple[int, str]:
+        '''Adds the content (bytes, or a file that is read in chunks) under the name, starting a new shard if the current
+        one would grow over `max_bytes`. A file added again under the same name replaces the previous one.
+        Returns the size and sha256 hash of the content.'''
+
+        size = len(source) if isinstance(source, bytes) else source.stat().st_size
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+        with self._lock:
+            if self._position > 0 and self._position + len(header) + _padded(size) + BLOCK_SIZE * 2 > self.max_bytes:
+                self._close_shard()
+                self._shard_number += 1
+                self._position = 0
+            if self._file is None:
+                self._open()
+
+            sha = hashlib.sha256()
+            self._file.write(header)
+            offset = self._position + len(header)
+            if isinstance(source, bytes):
+                sha.update(source)
+                self._file.write(source)
+            else:
+                with open(source, "rb") as file:
+                    for chunk in iter(lambda: file.read(1048576), b""):
+                        sha.update(chunk)
+                        self._file.write(chunk)
+            self._file.write(b"\0" * (_padded(size) - size))
+            self._file.flush()
+            self._position = offset + _padded(size)
+
+            entry = {"post_id": post_id, "name": name, "offset": offset, "size": size, "sha256": sha.hexdigest()}
+            with open(self._shard_path(self._shard_number).with_suffix(".idx"), "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+            self.entries[name] = {**entry, "shard": self._shard_path(self._shard_number).name}
+        return size, entry["sha256"]
+
+
+    def close(self) -> None:
+
+        with self._lock:
+            self._close_shard()
+
+
+    def __contains__(self, name: str) -> bool:
+
+        return name in self.entries
+
+
+    def get(self, name: str) -> dict | None:
+        '''Returns the index entry of the file: post ID, shard, offset, size and sha256.'''
+
+        return self.entries.get(name)
+
+
+    def discard(self, name: str) -> None:
+        '''Forgets the file until it is added again, for example to download a damaged file again. Its data stays in
+        the shard and its sidecar index line is kept, so it is listed again if it is never replaced.'''
+
+        with self._lock:
+            self.entries.pop(name, None)
+
+
+    def files_of(self, post_id: str) -> list[dict]:
+        '''Returns the index entries of the files of the post.'''
+
+        return [entry for entry in self.entries.values() if entry["post_id"] == post_id]
+
+
+    def read(self, name: str) -> bytes:
+        '''Returns the content of the file, read straight from its offset in the shard.'''
+
+        entry = self.entries[name]
+        with open(self.shard_dir / entry["shard"], "rb") as file:
+            file.seek(entry["offset"])
+            return file.read(entry["size"])
+
+
+    def extract(self, name: str, destination: Path) -> Path:
+        '''Writes the file to the destination directory, keeping its relative path. Returns the path written.'''
+
+        filepath = destination / name
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(filepath, "wb") as file:
+            file.write(self.read(name))
+        return filepath
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Browse and extract the packed archive of a user.")
+    parser.add_argument("path", type=str, help="Folder of the packed archive, for example 'Archive/username/Packed'.")
+    parser.add_argument("-i", "--id", type=str, help="Only the files of this post ID.")
+    parser.add_argument("-x", "--extract", type=str, help="Extract the files to this folder.")
+    args = parser.parse_args()
+
+    packed = PackedArchive(Path(args.path))
+    entries = packed.files_of(args.id) if args.id else list(packed.entries.values())
+    if args.extract:
+        for entry in entries:
+            print(packed.extract(entry["name"], Path(args.extract)))
+    else:
+        for entry in entries:
+            print(f'{entry["post_id"]}  {entry["name"]}  {entry["size"]} bytes  ({entry["shard"]} @ {entry["offset"]})')
+        print(f'{len(entries)} files.')
@@ -0,0 +1,146 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+
+class RateLimiter:
+    '''Token bucket limiting the request rate to a single host, shared by all the workers.
+    The rate adapts to the `x-ratelimit-remaining`/`x-ratelimit-reset` headers sent by Reddit,
+    and the whole host is paused when a response asks to back off with `Retry-After`.'''
+
+    def __init__(self, host: str, rate: float, burst: int, report=None, report_interval: float = 30.0) -> None:
+
+        self.host = host
+        self.rate = rate
+        self.default_rate = rate
+        self.burst = burst
+        self.report = report
+        self.report_interval = report_interval
+        self.requests = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._started = self._updated
+        self._window_start = self._updated
+        self._window_requests = 0
+        self._lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        '''Blocks until a request to the host is allowed. Tokens are reserved before sleeping,
+        so concurrent callers queue up behind each other instead of waking up together.'''
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate, self._paused_until - now)
+            self.requests += 1
+            self._window_requests += 1
+            report = self._take_report(now)
+
+        if report and self.report is not None:
+            self.report(report)
+        if wait:
+            time.sleep(wait)
+
+
+    def update(self, headers) -> None:
+        '''Adapts the rate to the rate limit headers of a response.'''
+
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = float(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if remaining < 1:
+                # Budget used up, wait for the window to reset.
+                self._paused_until = max(self._paused_until, now + reset)
+            elif reset > 0:
+                # Spread the remaining budget over the rest of the window.
+                self.rate = max(0.05, min(self.default_rate, remaining / reset))
+
+
+    def pause(self, seconds: float) -> None:
+        '''Stops all requests to the host for the given amount of seconds.'''
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+    def backoff(self, attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+        '''Returns the jittered exponential backoff delay for the retry attempt (full jitter).'''
+
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+    def sustained_rate(self) -> float:
+        '''Returns the average amount of requests per second since the limiter was created.'''
+
+        elapsed = time.monotonic() - self._started
+        return self.requests / elapsed if elapsed > 0 else 0.0
+
+
+    def _take_report(self, now: float) -> str | None:
+        '''Returns the rate report line when the report interval has passed. Must be called with the lock held.'''
+
+        elapsed = now - self._window_start
+        if elapsed < self.report_interval:
+            return None
+        line = f'[{self.host}] {self._window_requests / elapsed:.2f} req/s over the last {elapsed:.0f}s (limit {self.rate:.2f} req/s).'
+        self._window_start = now
+        self._window_requests = 0
+        return line
+
+
+class BandwidthLimiter:
+    '''Token bucket limiting the bytes per second read by all the workers together.
+    The budget is reserved before sleeping, like `RateLimiter.acquire`, so the readers share it fairly.'''
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def consume(self, size: int) -> float:
+        '''Blocks until the bytes fit in the budget. Returns the seconds waited.'''
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+            wait = max(0.0, -self._tokens / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    '''Returns the delay in seconds of a `Retry-After` header, which can be either seconds or an HTTP date.'''
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
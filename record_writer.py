@@ -0,0 +1,107 @@
+import gzip
+import json
+from pathlib import Path
+import threading
+import time
+
+
+class RecordWriter:
+    '''Buffered writer of the saved comments, links and self posts as gzip compressed JSON lines.
+    Records are kept in memory and appended to the file as a new gzip member once `batch_size` records are buffered,
+    or when a record is added more than `flush_interval` seconds after the last write (there is no background timer,
+    so call `flush` when done), instead of opening the file once per post.'''
+
+    def __init__(self, filepath: Path, batch_size: int = 500, flush_interval: float = 5.0) -> None:
+
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._callbacks = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def add(self, record: dict, on_written=None) -> int:
+        '''Buffers the record, flushing if the batch is full or the interval has passed. Returns the size of the line.
+        The optional `on_written` callback is called with the size of the line once the record is in the file.'''
+
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        size = len(line.encode("utf-8"))
+        with self._lock:
+            self._buffer.append(line)
+            if on_written is not None:
+                self._callbacks.append((on_written, size))
+            if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+        return size
+
+
+    def flush(self) -> None:
+        '''Writes the buffered records to the file.'''
+
+        with self._lock:
+            self._flush()
+
+
+    def _flush(self) -> None:
+
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        with gzip.open(self.filepath, "at", encoding="utf-8") as file:
+            file.write("".join(self._buffer))
+        self._buffer = []
+        callbacks, self._callbacks = self._callbacks, []
+        for callback, size in callbacks:
+            callback(size)
+
+
+def read_records(filepath: Path):
+    '''Yields the records of a file written by RecordWriter.'''
+
+    if not filepath.exists():
+        return
+    with gzip.open(filepath, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_unique_records(filepath: Path) -> list[dict]:
+    '''Returns the records of the file keeping only the latest record of each post ID, in the order first seen.'''
+
+    records = {}
+    for record in read_records(filepath):
+        records[record.get("id")] = record
+    return list(records.values())
+
+
+def export_text(user_path: Path) -> None:
+    '''Exports the records of the user archive to the plain text format: `comments.txt`, `link posts.txt`
+    and one `.txt` file per self post in `Self Posts`. Existing text files are overwritten.'''
+
+    with open(user_path / "comments.txt", "w", encoding="utf-8") as file:
+        for record in read_unique_records(user_path / "comments.jsonl.gz"):
+            title = record.get("link_title")
+            author = record.get("author")
+            url = record.get("link_permalink")
+            body = record.get("body")
+            file.write(f'{title = }\n{author = }\n{url = }\n\n{body}\n\n{"-"*50}\n\n')
+
+    with open(user_path / "link posts.txt", "w", encoding="utf-8") as file:
+        for record in read_unique_records(user_path / "links.jsonl.gz"):
+            title = record.get("title")
+            author = record.get("author")
+            url = record.get("url")
+            file.write(f'{title = }\n{author = }\n{url = }\n\n{"-"*50}\n\n')
+
+    selfpost_path = user_path / "Self Posts"
+    selfpost_path.mkdir(exist_ok=True)
+    for record in read_unique_records(user_path / "self posts.jsonl.gz"):
+        title = record.get("title")
+        author = record.get("author")
+        url = record.get("url")
+        content = record.get("selftext")
+        with open(selfpost_path / f'{record["id"]}.txt', "w", encoding="utf-8") as file:
+            file.write(f'{title = }\n{author = }\n{url = }\n\n{content}')
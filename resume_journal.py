@@ -0,0 +1,64 @@
+import json
+import os
+from pathlib import Path
+import threading
+
+
+class ResumeJournal:
+    '''Sidecar file recording the byte ranges of a partial download that are already on disk,
+    so an interrupted download only requests the missing ranges when it is restarted.
+    The journal is only trusted if the url, total size and range size match the current download.'''
+
+    def __init__(self, filepath: Path, url: str, total_size: int, chunk_size: int) -> None:
+
+        self.filepath = filepath
+        self.path = filepath.with_name(filepath.name + ".journal")
+        self.url = url
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.completed = set()
+        self._lock = threading.Lock()
+
+
+    def load(self) -> bool:
+        '''Loads the completed ranges of a previous attempt. Returns False (and starts over) if there is no usable
+        journal, or the partial file does not match the expected size.'''
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if (state.get("url", "").split("?")[0] != self.url.split("?")[0] or state.get("total_size") != self.total_size
+                or state.get("chunk_size") != self.chunk_size):
+            return False
+        if not self.filepath.exists() or self.filepath.stat().st_size != self.total_size:
+            return False
+
+        self.completed = {tuple(item) for item in state.get("completed", [])}
+        return True
+
+
+    def mark_done(self, start: int, end: int) -> None:
+        '''Records the range as written and persists the journal atomically.'''
+
+        with self._lock:
+            self.completed.add((start, end))
+            state = {
+                "url": self.url,
+                "total_size": self.total_size,
+                "chunk_size": self.chunk_size,
+                "completed": sorted(self.completed)
+            }
+            temp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(state, file)
+            os.replace(temp_path, self.path)
+
+
+    def remove(self) -> None:
+        '''Deletes the journal once the download is complete.'''
+
+        if self.path.exists():
+            os.remove(self.path)